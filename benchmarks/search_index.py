@@ -0,0 +1,128 @@
+"""
+Title search on a synthetic catalog: the in-memory SearchIndex against the
+lookahead regex search_tgfiles ran before, replayed with `re` over the same
+titles newest first and stopping at a full page like Mongo's sorted, limited
+scan would. Database round trips are left out of both.
+
+    python benchmarks/search_index.py --titles 1000000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+from itertools import accumulate
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# set before bot.config reads config.env, nothing here needs a database
+os.environ["DATABASE_URL"] = "mongodb://localhost:1"
+
+from bson import ObjectId
+
+from bot.helper.database import ranked_slice
+from bot.helper.search_index import SearchIndex
+
+PER_PAGE = 50
+TAGS = ["1080p", "720p", "2160p", "WEB-DL", "BluRay", "x264", "x265", "HEVC", "AAC", "HDR", "Dual Audio"]
+
+
+def make_words(rng, count):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+
+def make_title(rng, words, cum_weights):
+    name = " ".join(word.capitalize() for word in rng.choices(words, cum_weights=cum_weights, k=rng.randint(1, 4)))
+    if rng.random() < 0.6:
+        name += f" S{rng.randint(1, 12):02d}E{rng.randint(1, 24):02d}"
+    else:
+        name += f" {rng.randint(1950, 2025)}"
+    return f"{name} {' '.join(rng.sample(TAGS, 3))}"
+
+
+def regex_page(titles, query):
+    """
+    first page of the old search: every word somewhere in the title, any
+    case, newest first
+    """
+    words = re.findall(r'\w+', query.lower())
+    regex_pattern = '.*'.join(f'(?=.*{re.escape(word)})' for word in words)
+    regex = re.compile(f'.*{regex_pattern}.*', re.IGNORECASE)
+    page = []
+    for title in reversed(titles):
+        # PCRE anchors a pattern starting with .* by itself, re only does
+        # on match(), the same thing for titles without newlines
+        if regex.match(title):
+            page.append(title)
+            if len(page) > PER_PAGE:
+                break
+    return page[:PER_PAGE]
+
+
+def timed(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = perf_counter()
+        result = function(*args)
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, result
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--titles", type=int, default=1_000_000)
+    parser.add_argument("--words", type=int, default=50_000, help="vocabulary size, Zipf distributed")
+    parser.add_argument("--seed", type=int, default=24)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    words = make_words(rng, args.words)
+    rng.shuffle(words)
+    cum_weights = list(accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    titles = [make_title(rng, words, cum_weights) for _ in range(args.titles)]
+    # ObjectIds increase with insertion order, like the stored files
+    ids = [ObjectId() for _ in titles]
+
+    rss = rss_mb()
+    started = perf_counter()
+    index = SearchIndex()
+    scope = ("files", "-100")
+    for doc_id, title in zip(ids, titles):
+        index.add(scope, doc_id, title)
+    print(f"{args.titles} titles indexed in {perf_counter() - started:.1f} s, "
+          f"{rss_mb() - rss:.0f} MB, {len(index.words)} distinct words")
+
+    common, medium, rare = words[0], words[len(words) // 100], words[-1]
+    queries = [
+        ("common word", common),
+        ("mid-frequency word", medium),
+        ("rare word", rare),
+        ("two words", f"{common} {medium}"),
+        ("word and tag", f"{medium} 1080p"),
+        ("prefix", rare[:3]),
+        ("no match", "qqqqzz"),
+    ]
+    print(f"\n{'query':<20}{'matches':>9}{'index ms':>11}{'regex ms':>11}")
+    for label, query in queries:
+        index_ms, _ = timed(lambda q: ranked_slice(index.search(scope, q), None, PER_PAGE), query)
+        regex_ms, _ = timed(regex_page, titles, query, repeat=1)
+        print(f"{label:<20}{len(index.search(scope, query)):>9}{index_ms:>11.1f}{regex_ms:>11.1f}")
+
+    typo = medium[:-1] + ("a" if medium[-1] != "a" else "b")
+    fuzzy_ms, _ = timed(lambda q: ranked_slice(index.fuzzy(q), None, PER_PAGE), typo)
+    print(f"\nfuzzy '{typo}' for '{medium}' over the whole catalog: {fuzzy_ms:.1f} ms, "
+          f"{len(index.fuzzy(typo))} matches")
+
+
+if __name__ == "__main__":
+    main()
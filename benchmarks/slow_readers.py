@@ -0,0 +1,151 @@
+"""
+Peak RSS and CPU time of the streaming path while many viewers read slower
+than Telegram delivers: every stream goes through write_body and a
+ByteStreamer whose media session answers each GetFile after a fixed delay.
+The readers run in a child process so only the server side is measured.
+
+    python benchmarks/slow_readers.py --readers 500
+
+Settings come from the environment as for the bot, for example
+STREAM_BUFFER_SIZE=1 to hold a single chunk per stream.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# set before bot.config reads config.env, nothing here needs a database
+os.environ["DATABASE_URL"] = "mongodb://localhost:1"
+
+from aiohttp import web
+from pyrogram import raw
+from pyrogram.file_id import FileType
+
+from bot.server.custom_dl import ByteStreamer
+from bot.server.file_properties import FileMeta
+from bot.server.range_planner import CHUNK_SIZE
+from bot.server.stream_routes import write_body
+from bot.telegram import work_loads
+
+
+class FakeClient:
+    name = "benchmark"
+
+
+class FakeSession:
+    def __init__(self, data: bytes, latency: float):
+        self.data = data
+        self.latency = latency
+        self.calls = 0
+
+    async def send(self, query):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return raw.types.upload.File(type=raw.types.storage.FilePartial(), mtime=0,
+                                     bytes=self.data[query.offset:query.offset + query.limit])
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def slow_reader(port: int, number: int, rate: int, duration: float) -> int:
+    sock = socket.socket()
+    # a small fixed receive buffer, the kernel would otherwise grow it
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port))
+    reader, writer = await asyncio.open_connection(sock=sock)
+    writer.write(f"GET /{number} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    received = 0
+    started = perf_counter()
+    while perf_counter() - started < duration:
+        data = await reader.read(rate // 10)
+        if not data:
+            break
+        received += len(data)
+        await asyncio.sleep(0.1)
+    writer.close()
+    return received
+
+
+def run_readers(port: int, readers: int, rate: int, duration: float, results) -> None:
+    async def main():
+        return await asyncio.gather(*[slow_reader(port, number, rate, duration) for number in range(readers)])
+
+    results.put(sum(asyncio.run(main())))
+
+
+async def serve(args) -> None:
+    size = args.size * 2 ** 20
+    data = os.urandom(size)
+    session = FakeSession(data, args.latency)
+    streamer = ByteStreamer(FakeClient())
+
+    async def generate_media_session(client, file_id):
+        return session
+
+    streamer.generate_media_session = generate_media_session
+    work_loads[0] = 0
+
+    async def stream(request):
+        # a file per viewer, so no two of them share a download
+        file_meta = FileMeta(-100, int(request.match_info["number"]), 2, FileType.VIDEO, 1, 2, b"ref", "",
+                             size, "video/mp4", "benchmark.mp4", f"benchmark-{request.match_info['number']}", 0)
+        response = web.StreamResponse(headers={"Content-Length": str(size), "Content-Type": "video/mp4"})
+        return await write_body(request, response, streamer.yield_file(file_meta, 0, 0, size - 1))
+
+    app = web.Application()
+    app.router.add_get("/{number}", stream)
+    runner = web.AppRunner(app, handler_cancellation=True)
+    await runner.setup()
+    listener = socket.create_server(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    await web.SockSite(runner, listener).start()
+
+    baseline_rss, baseline_cpu = rss_mb(), cpu_seconds()
+    peak_rss = baseline_rss
+    results = multiprocessing.Queue()
+    readers = multiprocessing.Process(target=run_readers,
+                                      args=(port, args.readers, args.rate * 1024, args.duration, results))
+    readers.start()
+    while readers.is_alive():
+        peak_rss = max(peak_rss, rss_mb())
+        await asyncio.sleep(0.05)
+    received = results.get()
+    await asyncio.sleep(0.5)
+    cpu = cpu_seconds() - baseline_cpu
+    await runner.cleanup()
+
+    print(f"{args.readers} readers at {args.rate} KB/s for {args.duration:.0f} s, "
+          f"{args.size} MiB files, {args.latency * 1000:.0f} ms per GetFile")
+    print(f"RSS: {baseline_rss:.0f} MB before, {peak_rss:.0f} MB peak "
+          f"({(peak_rss - baseline_rss) / args.readers:.2f} MB per stream)")
+    print(f"CPU: {cpu:.2f} s")
+    print(f"GetFile calls: {session.calls} ({session.calls * CHUNK_SIZE / 2 ** 20:.0f} MiB), "
+          f"delivered: {received / 2 ** 20:.0f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--readers", type=int, default=500)
+    parser.add_argument("--rate", type=int, default=64, help="KB/s each reader consumes")
+    parser.add_argument("--duration", type=float, default=10, help="seconds each reader stays")
+    parser.add_argument("--size", type=int, default=64, help="MiB per file")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per GetFile")
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
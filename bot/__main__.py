@@ -6,8 +6,11 @@ from pyrogram import idle
 
 from bot import __version__, LOGGER
 from bot.config import Telegram
+from bot.helper.database import Database
 from bot.server import web_server
-from bot.telegram import StreamBot, UserBot
+from bot.server.file_properties import file_meta_cache
+from bot.server.media_session import start_session_pools, stop_session_pools
+from bot.telegram import StreamBot, UserBot, multi_clients
 from bot.telegram.clients import initialize_clients
 
 loop = get_event_loop()
@@ -16,6 +19,18 @@ async def start_services():
     LOGGER.info(f'Initializing Surf-TG v-{__version__}')
     await asleep(1.2)
     
+    db = Database()
+    try:
+        await db.normalize_msg_ids()
+    except Exception as e:
+        LOGGER.error(f"Could not normalize message ids: {e!r}")
+    try:
+        await db.ensure_indexes()
+    except Exception as e:
+        LOGGER.error(f"Could not check database indexes: {e!r}")
+    # search falls back to regex scans until this has loaded
+    loop.create_task(Database().load_search_index())
+
     await StreamBot.start()
     StreamBot.username = StreamBot.me.username
     LOGGER.info(f"Bot Client : [@{StreamBot.username}]")
@@ -27,10 +42,13 @@ async def start_services():
     await asleep(1.2)
     LOGGER.info("Initializing Multi Clients")
     await initialize_clients()
+    loop.create_task(start_session_pools(list(multi_clients.values())))
     
     await asleep(2)
     LOGGER.info('Initalizing Surf Web Server..')
-    server = web.AppRunner(await web_server())
+    # cancel a stream handler as soon as its viewer disconnects so the
+    # GetFile calls behind it stop too
+    server = web.AppRunner(await web_server(), handler_cancellation=True)
     LOGGER.info("Server CleanUp!")
     await server.cleanup()
     
@@ -40,10 +58,14 @@ async def start_services():
     await server.setup()
     await web.TCPSite(server, '0.0.0.0', Telegram.PORT).start()
 
+    loop.create_task(file_meta_cache.autosave())
+
     LOGGER.info("Surf-TG Started Revolving !")
     await idle()
 
 async def stop_clients():
+    file_meta_cache.save()
+    await stop_session_pools()
     await StreamBot.stop()
     if len(Telegram.SESSION_STRING) != 0:
         await UserBot.stop()
@@ -23,3 +23,30 @@ class Telegram:
     WORKERS = int(getenv('WORKERS', '10'))
     MULTI_CLIENT = getenv('MULTI_CLIENT', 'False')
     HIDE_CHANNEL = getenv('HIDE_CHANNEL', 'False')
+    PREFETCH_CHUNKS = int(getenv('PREFETCH_CHUNKS', '4'))
+    STRIPE_CLIENTS = int(getenv('STRIPE_CLIENTS', '1'))
+    STREAM_RETRIES = int(getenv('STREAM_RETRIES', '3'))
+    MEDIA_SESSIONS_PER_DC = int(getenv('MEDIA_SESSIONS_PER_DC', '2'))
+    MEDIA_SESSION_WARM_UP = getenv('MEDIA_SESSION_WARM_UP', 'True').lower() == 'true'
+    CHUNK_CACHE_SIZE = int(getenv('CHUNK_CACHE_SIZE', '0'))
+    CHUNK_CACHE_DIR = getenv('CHUNK_CACHE_DIR', 'cache/chunks')
+    HOT_CACHE_SIZE = int(getenv('HOT_CACHE_SIZE', '64'))
+    FILE_META_CACHE_SIZE = int(getenv('FILE_META_CACHE_SIZE', '10000'))
+    FILE_META_CACHE_TTL = int(getenv('FILE_META_CACHE_TTL', '3600'))
+    FILE_META_CACHE_FILE = getenv('FILE_META_CACHE_FILE', 'cache/file_meta.json')
+    STREAM_CACHE_CONTROL = getenv('STREAM_CACHE_CONTROL', 'public, max-age=31536000, immutable')
+    STREAM_BUFFER_SIZE = int(getenv('STREAM_BUFFER_SIZE', '8'))
+    CDN_DOWNLOADS = getenv('CDN_DOWNLOADS', 'True').lower() == 'true'
+    MP4_FASTSTART = getenv('MP4_FASTSTART', 'True').lower() == 'true'
+    MP4_INDEX_CACHE_SIZE = int(getenv('MP4_INDEX_CACHE_SIZE', '32'))
+    WATCH_PREFETCH = getenv('WATCH_PREFETCH', 'True').lower() == 'true'
+    PREFETCH_NEXT = getenv('PREFETCH_NEXT', 'True').lower() == 'true'
+    PREFETCH_BUDGET = int(getenv('PREFETCH_BUDGET', '2048'))
+    STREAM_SECRET = getenv('STREAM_SECRET', '')
+    STREAM_LINK_TTL = int(getenv('STREAM_LINK_TTL', '86400'))
+    REQUIRE_SIGNED_LINKS = getenv('REQUIRE_SIGNED_LINKS', 'False').lower() == 'true'
+    MONGO_POOL_SIZE = int(getenv('MONGO_POOL_SIZE', '50'))
+    MONGO_TIMEOUT = int(getenv('MONGO_TIMEOUT', '10000'))
+    UPSTREAM_CONCURRENCY = int(getenv('UPSTREAM_CONCURRENCY', '64'))
+    GLOBAL_RATE_LIMIT = int(getenv('GLOBAL_RATE_LIMIT', '0'))
+    CLIENT_RATE_LIMIT = int(getenv('CLIENT_RATE_LIMIT', '0'))
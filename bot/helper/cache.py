@@ -20,7 +20,7 @@ def rm_cache(channel=None):
 def get_cache(channel, page):
     if os.path.exists(f"cache/{channel}-{page}.json"):
         with open(f"cache/{channel}-{page}.json", "r") as f:
-            return json.load(f)["posts"]
+            return json.load(f)
     else:
         return None
 
@@ -0,0 +1,49 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as B64Error
+from typing import List, Optional, Tuple
+
+from bson import json_util
+
+NEXT = "next"
+PREV = "prev"
+
+
+def encode_cursor(direction: str, position: List) -> str:
+    """
+    opaque page token: which way to go from the sort key values `position`
+    """
+    data = json_util.dumps([direction, position]).encode()
+    return urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Tuple[str, Optional[List]]:
+    """
+    (direction, position), a missing or mangled cursor is the first page
+    """
+    if not cursor:
+        return NEXT, None
+    try:
+        direction, position = json_util.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (B64Error, ValueError, TypeError):
+        return NEXT, None
+    if direction not in (NEXT, PREV) or not isinstance(position, list):
+        return NEXT, None
+    return direction, position
+
+
+def page_cursors(direction: str, position: Optional[List], first: Optional[List], last: Optional[List],
+                 more: bool) -> Tuple[Optional[str], Optional[str]]:
+    """
+    (next, prev) cursors of a page whose first and last items sort at
+    `first` and `last`; `more` says whether the query found items beyond
+    the page in the direction it was read
+    """
+    if first is None:
+        # an empty page, offer the way back to where the viewer came from
+        if position is None:
+            return None, None
+        return (encode_cursor(NEXT, position), None) if direction == PREV else (None, encode_cursor(PREV, position))
+    has_next = more if direction == NEXT else True
+    has_prev = position is not None and (more if direction == PREV else True)
+    return (encode_cursor(NEXT, last) if has_next else None,
+            encode_cursor(PREV, first) if has_prev else None)
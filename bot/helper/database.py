@@ -1,125 +1,394 @@
-from pymongo import DESCENDING, MongoClient
+from bisect import bisect_left, bisect_right
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from bson import ObjectId
+from bot import LOGGER
 from bot.config import Telegram
+from bot.helper.cursor import NEXT, PREV, decode_cursor, page_cursors
+from bot.helper.search_index import search_index
 import re
 
+# one pool shared by every Database instance; timeoutMS bounds each
+# operation so a slow query fails instead of holding a request forever
+mongo_client = AsyncIOMotorClient(
+    Telegram.DATABASE_URL,
+    maxPoolSize=Telegram.MONGO_POOL_SIZE,
+    minPoolSize=min(Telegram.MONGO_POOL_SIZE, 5),
+    timeoutMS=Telegram.MONGO_TIMEOUT,
+    serverSelectionTimeoutMS=Telegram.MONGO_TIMEOUT,
+)
+
+# every query shape the app runs, created at startup by ensure_indexes;
+# config is only ever looked up by _id
+INDEXES = {
+    "files": [
+        # list_tgfiles / search_tgfiles: chat_id filter sorted by msg_id;
+        # add_tgfiles / add_btgfiles dedupe, a message is stored once
+        IndexModel([("chat_id", ASCENDING), ("msg_id", DESCENDING)], name="chat_id_msg_id", unique=True),
+    ],
+    "playlist": [
+        # get_playlist / search_dbfiles / get_Dbfolder / delete's child count
+        IndexModel([("parent_folder", ASCENDING), ("type", DESCENDING), ("file_id", DESCENDING),
+                    ("_id", DESCENDING)], name="parent_folder_type_file_id"),
+        # search_DbFolder: type filter sorted by _id
+        IndexModel([("type", ASCENDING), ("_id", DESCENDING)], name="type_id"),
+    ],
+}
+UNIQUE_FILES = "files.chat_id_msg_id"
+# "collection.name" of the declared indexes ensure_indexes found or built;
+# while UNIQUE_FILES isn't among them inserts check for the message first
+built_indexes = set()
+
+
+# what a cursor may hold for each sort key, anything else was tampered
+# with; folders have no file_id
+KEY_TYPES = {"msg_id": (int,), "type": (str,), "file_id": (str, type(None)), "_id": (ObjectId,)}
+# search results are ordered by (score, _id bytes), an empty query scores 0
+RANK_TYPES = ((float, int), (bytes,))
+
+
+def valid_position(position, types):
+    """
+    whether every value of a decoded cursor position has an allowed type,
+    so nothing else reaches a Mongo filter or a comparison with real keys
+    """
+    # exact types, True is an int and a dict could carry query operators
+    return len(position) == len(types) and all(type(value) in allowed for value, allowed in zip(position, types))
+
+
+def keyset_filter(keys, position, operator):
+    """
+    documents sorting strictly past `position` on `keys`:
+    a < A, or a == A and b < B, and so on for "$lt"
+    """
+    return {"$or": [{**dict(zip(keys[:i], position[:i])), key: {operator: position[i]}}
+                    for i, key in enumerate(keys)]}
+
+
+async def keyset_page(collection, query, keys, cursor, per_page):
+    """
+    one page of `query` sorted by `keys` descending, starting after (or
+    ending before) the position in `cursor`, as (documents, next, prev);
+    unlike skip() it costs the same on every page and inserts between
+    requests don't shift it
+    """
+    direction, position = decode_cursor(cursor)
+    if position is not None and not valid_position(position, [KEY_TYPES[key] for key in keys]):
+        direction, position = NEXT, None
+    if position is not None:
+        query = {"$and": [query, keyset_filter(keys, position, "$gt" if direction == PREV else "$lt")]}
+    order = ASCENDING if direction == PREV else DESCENDING
+    documents = await collection.find(query).sort([(key, order) for key in keys]).limit(
+        per_page + 1).to_list(per_page + 1)
+    more = len(documents) > per_page
+    documents = documents[:per_page]
+    if direction == PREV:
+        documents.reverse()
+    first, last = ([[document.get(key) for key in keys] for document in (documents[0], documents[-1])]
+                   if documents else (None, None))
+    return (documents, *page_cursors(direction, position, first, last, more))
+
+
+def ranked_slice(ranked, cursor, per_page):
+    """
+    keyset page over search results in ascending (score, _id bytes) order,
+    read from the end since the best match comes first, as
+    (ids, next, prev)
+    """
+    direction, position = decode_cursor(cursor)
+    if position is not None and not valid_position(position, RANK_TYPES):
+        direction, position = NEXT, None
+    if position is None:
+        end = len(ranked)
+        start = max(0, end - per_page)
+        more = start > 0
+    elif direction == PREV:
+        start = bisect_right(ranked, tuple(position))
+        end = min(len(ranked), start + per_page)
+        more = end < len(ranked)
+    else:
+        end = bisect_left(ranked, tuple(position))
+        start = max(0, end - per_page)
+        more = start > 0
+    page = ranked[start:end][::-1]
+    first, last = (list(page[0]), list(page[-1])) if page else (None, None)
+    return ([ObjectId(doc_id) for _, doc_id in page], *page_cursors(direction, position, first, last, more))
+
+
+async def ranked_page(collection, ranked, cursor, per_page):
+    ids, next_cursor, prev_cursor = ranked_slice(ranked, cursor, per_page)
+    found = {document["_id"]: document async for document in collection.find({"_id": {"$in": ids}})}
+    return [found[doc_id] for doc_id in ids if doc_id in found], next_cursor, prev_cursor
+
+
+def file_scope(chat_id):
+    return "files", str(chat_id)
+
+
+def playlist_scope(document):
+    # folders are searched all together, files within their playlist
+    if document.get("type") == "folder":
+        return ("folders",)
+    return "playlist", document.get("parent_folder")
+
 
 class Database:
     def __init__(self):
-        MONGODB_URI = Telegram.DATABASE_URL
-        self.mongo_client = MongoClient(MONGODB_URI)
+        self.mongo_client = mongo_client
         self.db = self.mongo_client["surftg"]
         self.collection = self.db["playlist"]
         self.config = self.db["config"]
         self.files = self.db["files"]
 
+    async def ensure_indexes(self):
+        """
+        create the declared indexes and log the ones that are still missing
+        and the ones Mongo has that nothing declares or that went unused
+        """
+        missing, unused = [], []
+        for name, indexes in INDEXES.items():
+            collection = self.db[name]
+            for index in indexes:
+                try:
+                    await self.create_index(collection, index)
+                    built_indexes.add(f"{name}.{index.document['name']}")
+                except OperationFailure as e:
+                    missing.append(f"{name}.{index.document['name']}")
+                    LOGGER.warning(f"Could not create index {name}.{index.document['name']}: {e}")
+            declared = {index.document["name"] for index in indexes} | {"_id_"}
+            existing = await collection.index_information()
+            unused += [f"{name}.{index}" for index in existing if index not in declared]
+            # access counters restart with mongod, so a declared index
+            # reported here may just not have been needed yet
+            try:
+                async for usage in collection.aggregate([{"$indexStats": {}}]):
+                    if usage["name"] in declared - {"_id_"} and not usage["accesses"]["ops"]:
+                        LOGGER.info(f"Index {name}.{usage['name']} has not been used since "
+                                    f"{usage['accesses']['since']:%Y-%m-%d %H:%M}")
+            except OperationFailure:
+                pass
+        if missing:
+            LOGGER.warning(f"Missing indexes: {', '.join(missing)}")
+        if unused:
+            LOGGER.info(f"Indexes not declared by Surf-TG, consider dropping: {', '.join(unused)}")
+        return missing, unused
+
+    async def create_index(self, collection, index):
+        try:
+            await collection.create_indexes([index])
+        except OperationFailure as e:
+            # duplicates stored before the unique index existed, which of
+            # them to keep is up to an admin, until then it stays missing
+            if index.document.get("unique") and e.code == 11000:
+                await self.log_duplicates(collection, index)
+            raise
+
+    async def normalize_msg_ids(self):
+        """
+        the channel handler used to store message ids as strings, which
+        sort apart from the ints /index stores and break range queries
+        """
+        result = await self.files.update_many({"msg_id": {"$type": "string"}},
+                                              [{"$set": {"msg_id": {"$toInt": "$msg_id"}}}])
+        if result.modified_count:
+            LOGGER.info(f"Converted {result.modified_count} message ids to int")
+
+    async def load_search_index(self):
+        async for file in self.files.find({}, {"chat_id": 1, "title": 1}):
+            search_index.add(file_scope(file.get("chat_id")), file["_id"], file.get("title"))
+        async for document in self.collection.find({"type": {"$in": ["folder", "file"]}},
+                                                   {"parent_folder": 1, "type": 1, "name": 1}):
+            search_index.add(playlist_scope(document), document["_id"], document.get("name"))
+        search_index.ready = True
+        LOGGER.info(f"Search index ready with {len(search_index.docs)} titles")
+
+    async def log_duplicates(self, collection, index, limit=20):
+        """
+        log the groups of documents a unique index would reject, nothing is
+        deleted
+        """
+        keys = list(index.document["key"])
+        pipeline = [{"$group": {"_id": {key: f"${key}" for key in keys},
+                                "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+                    {"$match": {"count": {"$gt": 1}}},
+                    {"$limit": limit}]
+        async for group in collection.aggregate(pipeline, allowDiskUse=True):
+            LOGGER.warning(f"Duplicate {collection.name} documents for {group['_id']}: "
+                           f"{', '.join(str(doc_id) for doc_id in group['ids'])}")
+        LOGGER.warning(f"Remove the duplicates from {collection.name} and restart to create "
+                       f"{index.document['name']} (at most {limit} groups are listed)")
+
     async def create_folder(self, parent_id, folder_name, thumbnail):
         folder = {"parent_folder": parent_id, "name": folder_name,
                   "thumbnail": thumbnail, "type": "folder"}
-        self.collection.insert_one(folder)
+        await self.collection.insert_one(folder)
+        search_index.add(playlist_scope(folder), folder["_id"], folder_name)
 
-    def delete(self, document_id):
+    async def delete(self, document_id):
         try:
-            has_child_documents = self.collection.count_documents(
-                {'parent_folder': document_id}) > 0
-            if has_child_documents:
-                result = self.collection.delete_many(
+            children = [child["_id"] async for child in self.collection.find(
+                {'parent_folder': document_id}, {"_id": 1})]
+            if children:
+                result = await self.collection.delete_many(
                     {'parent_folder': document_id})
-            result = self.collection.delete_one({'_id': ObjectId(document_id)})
+            result = await self.collection.delete_one({'_id': ObjectId(document_id)})
+            for doc_id in [*children, ObjectId(document_id)]:
+                search_index.remove(doc_id)
             return result.deleted_count > 0
         except Exception as e:
             print(f'An error occurred: {e}')
             return False
 
     async def edit(self, id, name, thumbnail):
-        result = self.collection.update_one({"_id": ObjectId(id)}, {
+        result = await self.collection.update_one({"_id": ObjectId(id)}, {
             "$set": {"name": name, "thumbnail": thumbnail}})
+        if result.modified_count and (document := await self.collection.find_one(
+                {"_id": ObjectId(id)}, {"parent_folder": 1, "type": 1})):
+            search_index.add(playlist_scope(document), document["_id"], name)
         return result.modified_count > 0
 
     async def search_DbFolder(self, query):
+        if search_index.ready:
+            ids = [ObjectId(doc_id) for _, doc_id in reversed(search_index.search(("folders",), query))]
+            names = {x['_id']: x['name'] async for x in self.collection.find({'_id': {'$in': ids}}, {'name': 1})}
+            return [{'_id': str(doc_id), 'name': names[doc_id]} for doc_id in ids if doc_id in names]
         words = re.findall(r'\w+', query.lower())
         regex_pattern = '.*'.join(f'(?=.*{re.escape(word)})' for word in words)
         regex_query = {'$regex': f'.*{regex_pattern}.*', '$options': 'i'}
         myquery = {'type': 'folder', 'name': regex_query}
         mydoc = self.collection.find(myquery).sort('_id', DESCENDING)
-        return [{'_id': str(x['_id']), 'name': x['name']} for x in mydoc]
+        return [{'_id': str(x['_id']), 'name': x['name']} async for x in mydoc]
 
     async def add_json(self, data):
-        result = self.collection.insert_many(data)
-
-    async def get_Dbfolder(self, parent_id="root", page=1, per_page=50):
-        query = {"parent_folder": parent_id, "type": "folder"} if parent_id != 'root' else {
-            "parent_folder": 'root', "type": "folder"}
-        if parent_id != 'root':
-            offset = (int(page) - 1) * per_page
-            return list(self.collection.find(query).skip(offset).limit(per_page))
-        else:
-            return list(self.collection.find(query))
+        result = await self.collection.insert_many(data)
+        for document in data:
+            search_index.add(playlist_scope(document), document["_id"], document.get("name"))
 
-    async def get_dbFiles(self, parent_id=None, page=1, per_page=50):
-        query = {"parent_folder": parent_id, "type": "file"}
-        offset = (int(page) - 1) * per_page
-        return list(self.collection.find(query).sort(
-            'file_id', DESCENDING).skip(offset).limit(per_page))
+    async def get_Dbfolder(self, parent_id="root"):
+        query = {"parent_folder": parent_id, "type": "folder"}
+        return [folder async for folder in self.collection.find(query)]
+
+    async def get_playlist(self, parent_id=None, cursor=None, per_page=50):
+        # sub folders sort before files ("folder" > "file") and have no file_id
+        query = {"parent_folder": parent_id, "type": {"$in": ["folder", "file"]}}
+        return await keyset_page(self.collection, query, ["type", "file_id", "_id"], cursor, per_page)
 
     async def get_info(self, id):
         query = {'_id': ObjectId(id)}
-        if document := self.collection.find_one(query):
+        if document := await self.collection.find_one(query):
             return document.get('name', None)
         else:
             return None
 
-    async def search_dbfiles(self, id, query, page=1, per_page=50):
+    async def search_dbfiles(self, id, query, cursor=None, per_page=50):
+        if search_index.ready:
+            ranked = search_index.search(("playlist", id), query)
+            return await ranked_page(self.collection, ranked, cursor, per_page)
+        # regex scan until the search index has loaded
         words = re.findall(r'\w+', query.lower())
         regex_pattern = '.*'.join(f'(?=.*{re.escape(word)})' for word in words)
         regex_query = {'$regex': f'.*{regex_pattern}.*', '$options': 'i'}
         query = {'type': 'file', 'parent_folder': id, 'name': regex_query}
-        offset = (int(page) - 1) * per_page
-        mydoc = self.collection.find(query).sort(
-            'file_id', DESCENDING).skip(offset).limit(per_page)
-        return list(mydoc)
+        return await keyset_page(self.collection, query, ["file_id", "_id"], cursor, per_page)
 
     async def update_config(self, theme, auth_channel):
         bot_id = Telegram.BOT_TOKEN.split(":", 1)[0]
-        config = self.config.find_one({"_id": bot_id})
+        config = await self.config.find_one({"_id": bot_id})
         if config is None:
-            result = self.config.insert_one(
+            result = await self.config.insert_one(
                 {"_id": bot_id, "theme": theme, "auth_channel": auth_channel})
             return result.inserted_id is not None
         else:
-            result = self.config.update_one({"_id": bot_id}, {
+            result = await self.config.update_one({"_id": bot_id}, {
                 "$set": {"theme": theme, "auth_channel": auth_channel}})
             return result.modified_count > 0
 
     async def get_variable(self, key):
         bot_id = Telegram.BOT_TOKEN.split(":", 1)[0]
-        config = self.config.find_one({"_id": bot_id})
+        config = await self.config.find_one({"_id": bot_id})
         return config.get(key) if config is not None else None
 
-    async def list_tgfiles(self, id, page=1, per_page=50):
+    async def list_tgfiles(self, id, cursor=None, per_page=50):
         query = {'chat_id': id}
-        offset = (int(page) - 1) * per_page
-        mydoc = self.files.find(query).sort(
-            'msg_id', DESCENDING).skip(offset).limit(per_page)
-        return list(mydoc)
+        return await keyset_page(self.files, query, ["msg_id"], cursor, per_page)
 
     async def add_tgfiles(self, chat_id, file_id, hash, name, size, file_type):
-        if fetch_old := self.files.find_one({"chat_id": chat_id, "hash": hash}):
-            return
-        file = {"chat_id": chat_id, "msg_id": file_id,
+        file = {"chat_id": chat_id, "msg_id": int(file_id),
                 "hash": hash, "title": name, "size": size, "type": file_type}
-        self.files.insert_one(file)
+        if UNIQUE_FILES not in built_indexes and await self.files.find_one(
+                {"chat_id": chat_id, "msg_id": file["msg_id"]}, {"_id": 1}):
+            return
+        try:
+            await self.files.insert_one(file)
+        except DuplicateKeyError:
+            # the message is already indexed
+            return
+        search_index.add(file_scope(chat_id), file["_id"], name)
+
+    async def delete_file(self, chat_id, msg_id, hash):
+        # message ids stored before normalize_msg_ids ran may still be str
+        ids = [file["_id"] async for file in self.files.find(
+            {"chat_id": str(chat_id), "hash": hash, "msg_id": {"$in": [str(msg_id), int(msg_id)]}}, {"_id": 1})]
+        result = await self.files.delete_many({"_id": {"$in": ids}})
+        for doc_id in ids:
+            search_index.remove(doc_id)
+        return result.deleted_count > 0
 
 
-    async def search_tgfiles(self, id, query, page=1, per_page=50):
+    async def search_tgfiles(self, id, query, cursor=None, per_page=50):
+        if search_index.ready:
+            ranked = search_index.search(file_scope(id), query)
+            return await ranked_page(self.files, ranked, cursor, per_page)
+        # regex scan until the search index has loaded
         words = re.findall(r'\w+', query.lower())
         regex_pattern = '.*'.join(f'(?=.*{re.escape(word)})' for word in words)
         regex_query = {'$regex': f'.*{regex_pattern}.*', '$options': 'i'}
         query = {'chat_id': id, 'title': regex_query}
-        offset = (int(page) - 1) * per_page
-        mydoc = self.files.find(query).sort(
-            'msg_id', DESCENDING).skip(offset).limit(per_page)
-        return list(mydoc)
+        return await keyset_page(self.files, query, ["msg_id"], cursor, per_page)
     
+    async def search_all(self, query, cursor=None, per_page=50):
+        """
+        typo tolerant search over every channel, playlist and folder; the
+        documents are tagged with the collection they came from
+        """
+        ids, next_cursor, prev_cursor = ranked_slice(search_index.fuzzy(query), cursor, per_page)
+        found = {}
+        for kind, collection in (("file", self.files), ("playlist", self.collection)):
+            async for document in collection.find({"_id": {"$in": ids}}):
+                found[document["_id"]] = {**document, "source": kind}
+        return [found[doc_id] for doc_id in ids if doc_id in found], next_cursor, prev_cursor
+
+    async def unstored_files(self, data):
+        """
+        the files of `data` whose message isn't stored yet, each once; the
+        check the unique index does when it exists
+        """
+        stored = set()
+        for chat_id in {file["chat_id"] for file in data}:
+            msg_ids = [file["msg_id"] for file in data if file["chat_id"] == chat_id]
+            stored |= {(chat_id, file["msg_id"]) async for file in self.files.find(
+                {"chat_id": chat_id, "msg_id": {"$in": msg_ids}}, {"msg_id": 1})}
+        unstored = []
+        for file in data:
+            if (key := (file["chat_id"], file["msg_id"])) not in stored:
+                stored.add(key)
+                unstored.append(file)
+        return unstored
+
     async def add_btgfiles(self, data):
-        result = self.files.insert_many(data)
+        if UNIQUE_FILES not in built_indexes:
+            data = await self.unstored_files(data)
+        if not data:
+            return
+        failed = set()
+        try:
+            # unordered so one message that is already indexed doesn't stop the rest
+            await self.files.insert_many(data, ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            failed = {error["index"] for error in e.details["writeErrors"]}
+        for index, file in enumerate(data):
+            if index not in failed:
+                search_index.add(file_scope(file["chat_id"]), file["_id"], file.get("title"))
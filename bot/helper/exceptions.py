@@ -2,5 +2,9 @@ class InvalidHash(Exception):
     message = 'Invalid hash!'
 
 
+class InvalidSignature(Exception):
+    message = 'Invalid or expired link!'
+
+
 class FIleNotFound(Exception):
     message = 'File not found!'
\ No newline at end of file
@@ -1,6 +1,8 @@
 from os.path import splitext
 import re
+from pyrogram import raw, utils
 from bot.config import Telegram
+from bot.helper.cursor import NEXT, PREV, decode_cursor, page_cursors
 from bot.helper.database import Database
 from bot.telegram import StreamBot, UserBot
 from bot.helper.file_size import get_readable_file_size
@@ -39,13 +41,52 @@ async def get_messages(chat_id, first_message_id, last_message_id, batch_size=50
     return messages
 
 
-async def get_files(chat_id, page=1):
-    if Telegram.SESSION_STRING == '':
-        return await db.list_tgfiles(id=chat_id, page=page)
-    if cache := get_cache(chat_id, int(page)):
-        return cache
+def history_position(cursor=None):
+    """
+    (direction, message id) a history cursor points at, anything else is
+    the first page
+    """
+    direction, position = decode_cursor(cursor)
+    try:
+        offset_id = int(position[0]) if position else 0
+    except (TypeError, ValueError):
+        offset_id = 0
+    if offset_id <= 0:
+        return NEXT, 0
+    return direction, offset_id
+
+
+async def get_history(chat_id, cursor=None, query="", limit=50):
+    """
+    a page of the chat's messages, or of its search results for `query`,
+    older than the cursor position or newer for a prev cursor; keyed on
+    message ids so new posts don't shift pages that are already open
+    """
+    direction, offset_id = history_position(cursor)
+    if direction == PREV:
+        # the window right above offset_id, which it may include, one
+        # message more than the page to know if there is yet another
+        add_offset, request_limit, min_id = -(limit + 2), limit + 2, offset_id
+    else:
+        add_offset, request_limit, min_id = 0, limit + 1, 0
+    peer = await UserBot.resolve_peer(int(chat_id))
+    if query:
+        r = await UserBot.invoke(raw.functions.messages.Search(
+            peer=peer, q=str(query), filter=raw.types.InputMessagesFilterEmpty(), min_date=0, max_date=0,
+            offset_id=offset_id, add_offset=add_offset, limit=request_limit, max_id=0, min_id=min_id, hash=0),
+            sleep_threshold=60)
+    else:
+        r = await UserBot.invoke(raw.functions.messages.GetHistory(
+            peer=peer, offset_id=offset_id, offset_date=0, add_offset=add_offset, limit=request_limit,
+            max_id=0, min_id=min_id, hash=0), sleep_threshold=60)
+    messages = [message for message in await utils.parse_messages(UserBot, r, replies=0)
+                if not min_id or message.id > min_id]
+    more = len(messages) > limit
+    # newest first, a prev page keeps the messages closest to the cursor
+    messages = messages[-limit:] if direction == PREV else messages[:limit]
+    first, last = ([messages[0].id], [messages[-1].id]) if messages else (None, None)
     posts = []
-    async for post in UserBot.get_chat_history(chat_id=int(chat_id), limit=50, offset=(int(page) - 1) * 50):
+    for post in messages:
         file = post.video or post.document
         if not file:
             continue
@@ -55,8 +96,21 @@ async def get_files(chat_id, page=1):
         poster = fetch_poster(title)
         posts.append({"msg_id": post.id, "title": title, "poster_url": poster,
                     "hash": file.file_unique_id[:6], "size": get_readable_file_size(file.file_size), "type": file.mime_type})
-    save_cache(chat_id, {"posts": posts}, page)
-    return posts
+    return (posts, *page_cursors(direction, [offset_id] if offset_id else None, first, last, more))
+
+
+async def get_files(chat_id, cursor=None):
+    if Telegram.SESSION_STRING == '':
+        return await db.list_tgfiles(id=chat_id, cursor=cursor)
+    # keyed by what the cursor decodes to, a mangled cursor is the first
+    # page and never makes a cache file of its own
+    direction, offset_id = history_position(cursor)
+    page = f"{direction}-{offset_id}" if offset_id else "head"
+    if cache := get_cache(chat_id, page):
+        return cache["posts"], cache["next"], cache["prev"]
+    posts, next_cursor, prev_cursor = await get_history(chat_id, cursor)
+    save_cache(chat_id, {"posts": posts, "next": next_cursor, "prev": prev_cursor}, page)
+    return posts, next_cursor, prev_cursor
 
 async def posts_file(posts, chat_id):
     phtml = """
@@ -1,24 +1,9 @@
-import re
 from bot.config import Telegram
 from bot.helper.database import Database
-from bot.telegram import UserBot
-from os.path import splitext
-from bot.helper.tmdb import fetch_poster
-from bot.helper.file_size import get_readable_file_size
+from bot.helper.index import get_history
 
 db = Database()
-async def search(chat_id, query, page):
+async def search(chat_id, query, cursor=None):
     if Telegram.SESSION_STRING == '':
-        return await db.search_tgfiles(id=chat_id, query=query, page=page)
-    posts = []
-    async for post in UserBot.search_messages(chat_id=int(chat_id), limit=50, query=str(query), offset=(int(page) - 1) * 50):
-        file = post.video or post.document
-        if not file:
-            continue
-        title = post.caption
-        title, _ = splitext(title)
-        title = re.sub(r'[.,|_\',]', ' ', title)
-        poster = fetch_poster(title)
-        posts.append({"msg_id": post.id, "title": title, "poster_url": poster,
-                     "hash": file.file_unique_id[:6], "size": get_readable_file_size(file.file_size), "type": file.mime_type})
-    return posts
+        return await db.search_tgfiles(id=chat_id, query=query, cursor=cursor)
+    return await get_history(chat_id, cursor, query=query)
@@ -0,0 +1,200 @@
+import re
+from bisect import bisect_left, insort
+from collections import Counter
+from math import log
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+
+# a query word matching only the start of a title word counts this much
+# of a whole-word match
+PREFIX_WEIGHT = 0.5
+# prefixes shorter than this only match whole words, "a" would otherwise
+# expand to a good part of the vocabulary
+MIN_PREFIX = 2
+
+# title words sharing at least this share of trigrams with a query word
+# (Jaccard) match it in the global fuzzy search, enough for a typo or two
+# in a release name
+FUZZY_THRESHOLD = 0.3
+
+WORD_RE = re.compile(r"[^\W_]+")
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return WORD_RE.findall((text or "").casefold())
+
+
+def trigrams(word: str) -> Set[str]:
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Scope:
+    """
+    Postings of one searchable list (a chat, a playlist, the folders) and
+    its vocabulary kept sorted for prefix lookups.
+    """
+    __slots__ = ("postings", "vocabulary", "docs")
+
+    def __init__(self):
+        self.postings: Dict[str, Set[int]] = {}
+        self.vocabulary: List[str] = []
+        self.docs: Set[int] = set()
+
+    def add(self, doc: int, tokens: Set[str]) -> None:
+        self.docs.add(doc)
+        for token in tokens:
+            if (docs := self.postings.get(token)) is None:
+                docs = self.postings[token] = set()
+                insort(self.vocabulary, token)
+            docs.add(doc)
+
+    def remove(self, doc: int, tokens: Set[str]) -> None:
+        self.docs.discard(doc)
+        for token in tokens:
+            docs = self.postings[token]
+            docs.discard(doc)
+            if not docs:
+                del self.postings[token]
+                del self.vocabulary[bisect_left(self.vocabulary, token)]
+
+    def expand(self, word: str) -> List[str]:
+        if len(word) < MIN_PREFIX:
+            return [word] if word in self.postings else []
+        tokens = []
+        for token in self.vocabulary[bisect_left(self.vocabulary, word):]:
+            if not token.startswith(word):
+                break
+            tokens.append(token)
+        return tokens
+
+    def idf(self, token: str) -> float:
+        return log(1 + len(self.docs) / len(self.postings[token]))
+
+
+class SearchIndex:
+    """
+    In-memory inverted index over titles, one scope per chat, playlist or
+    the folder list. Query words match title words they are a prefix of,
+    every word has to match, and results are ordered by the summed idf of
+    the matches, whole words weighing more than prefixes, then newest
+    first. Documents are identified by their Mongo _id.
+
+    Across all scopes it also keeps every title word and the words each
+    trigram occurs in, for typo tolerant searches over the whole catalog.
+    """
+
+    def __init__(self):
+        self.scopes: Dict[Hashable, Scope] = {}
+        self.words: Dict[str, Set[int]] = {}
+        self.trigrams: Dict[str, Set[str]] = {}
+        self.docs: Dict[ObjectId, int] = {}
+        self.entries: Dict[int, Tuple[ObjectId, Hashable, Set[str]]] = {}
+        self.next_doc = 0
+        self.ready = False
+        self.searches = 0
+
+    def add(self, scope: Hashable, doc_id: ObjectId, text: Optional[str]) -> None:
+        self.remove(doc_id)
+        doc = self.next_doc
+        self.next_doc += 1
+        tokens = set(tokenize(text))
+        self.docs[doc_id] = doc
+        self.entries[doc] = (doc_id, scope, tokens)
+        self.scopes.setdefault(scope, Scope()).add(doc, tokens)
+        for token in tokens:
+            if (docs := self.words.get(token)) is None:
+                docs = self.words[token] = set()
+                for trigram in trigrams(token):
+                    self.trigrams.setdefault(trigram, set()).add(token)
+            docs.add(doc)
+
+    def remove(self, doc_id: ObjectId) -> None:
+        if (doc := self.docs.pop(doc_id, None)) is None:
+            return
+        _, scope, tokens = self.entries.pop(doc)
+        self.scopes[scope].remove(doc, tokens)
+        if not self.scopes[scope].docs:
+            del self.scopes[scope]
+        for token in tokens:
+            docs = self.words[token]
+            docs.discard(doc)
+            if docs:
+                continue
+            del self.words[token]
+            for trigram in trigrams(token):
+                words = self.trigrams[trigram]
+                words.discard(token)
+                if not words:
+                    del self.trigrams[trigram]
+
+    def search(self, scope: Hashable, query: str) -> List[Tuple[float, bytes]]:
+        """
+        (score, _id bytes) of every match in ascending order, bytes compare
+        in C where ObjectId's __lt__ would dominate large result sets
+        """
+        self.searches += 1
+        if (index := self.scopes.get(scope)) is None:
+            return []
+        scores: Optional[Dict[int, float]] = None
+        for word in set(tokenize(query)):
+            matches: Dict[int, float] = {}
+            for token in index.expand(word):
+                weight = index.idf(token) * (1 if token == word else PREFIX_WEIGHT)
+                for doc in index.postings[token]:
+                    if weight > matches.get(doc, 0):
+                        matches[doc] = weight
+            if scores is None:
+                scores = matches
+            else:
+                scores = {doc: score + matches[doc] for doc, score in scores.items() if doc in matches}
+            if not scores:
+                return []
+        if scores is None:
+            # no words, everything matches like the empty regex used to
+            scores = dict.fromkeys(index.docs, 0)
+        # rounded so scores survive the trip through a cursor unchanged
+        return sorted((round(score, 6), self.entries[doc][0].binary) for doc, score in scores.items())
+
+    def similar(self, word: str) -> Dict[str, float]:
+        """
+        title words within FUZZY_THRESHOLD of `word` and their similarity
+        """
+        wanted = trigrams(word)
+        shared = Counter(token for trigram in wanted for token in self.trigrams.get(trigram, ()))
+        matches = {}
+        for token, count in shared.items():
+            similarity = count / (len(wanted) + len(trigrams(token)) - count)
+            if similarity >= FUZZY_THRESHOLD:
+                matches[token] = similarity
+        return matches
+
+    def fuzzy(self, query: str) -> List[Tuple[float, bytes]]:
+        """
+        (score, _id bytes) of titles in every scope with a similar word for
+        each query word, in ascending order like search(); a word scores
+        its similarity times its idf over the whole catalog
+        """
+        self.searches += 1
+        scores: Optional[Dict[int, float]] = None
+        for word in set(tokenize(query)):
+            matches: Dict[int, float] = {}
+            for token, similarity in self.similar(word).items():
+                weight = similarity * log(1 + len(self.docs) / len(self.words[token]))
+                for doc in self.words[token]:
+                    if weight > matches.get(doc, 0):
+                        matches[doc] = weight
+            scores = matches if scores is None else \
+                {doc: score + matches[doc] for doc, score in scores.items() if doc in matches}
+            if not scores:
+                return []
+        return sorted((round(score, 6), self.entries[doc][0].binary) for doc, score in (scores or {}).items())
+
+    def stats(self) -> dict:
+        return {"ready": self.ready, "documents": len(self.docs), "scopes": len(self.scopes),
+                "words": len(self.words), "trigrams": len(self.trigrams),
+                "searches": self.searches}
+
+
+search_index = SearchIndex()
@@ -0,0 +1,40 @@
+import hmac
+from base64 import urlsafe_b64encode
+from hashlib import sha256
+from time import time
+from typing import Mapping
+from urllib.parse import urlencode
+
+from bot.config import Telegram
+
+# without a configured secret, links stay valid across restarts as long as
+# the bot token doesn't change
+SECRET = (Telegram.STREAM_SECRET or sha256(f"stream-links:{Telegram.BOT_TOKEN}".encode()).hexdigest()).encode()
+SIGNED_FIELDS = ("hash", "size", "mime", "exp")
+
+
+def get_signature(chat_id: int, message_id: int, params: Mapping[str, str]) -> str:
+    payload = ":".join([str(chat_id), str(message_id), *(str(params.get(field, "")) for field in SIGNED_FIELDS)])
+    return urlsafe_b64encode(hmac.new(SECRET, payload.encode(), sha256).digest()[:18]).decode()
+
+
+def sign_stream_query(chat_id: int, message_id: int, secure_hash: str, size: int, mime: str) -> str:
+    """
+    query string of a stream link for the message; the expiry is rounded up
+    to whole TTL periods so every page view in a period gets the same URL
+    and an edge cache can key on it
+    """
+    ttl = Telegram.STREAM_LINK_TTL
+    params = {"id": message_id, "hash": secure_hash, "size": size, "mime": mime or "",
+              "exp": (int(time()) // ttl + 2) * ttl}
+    params["sig"] = get_signature(chat_id, message_id, params)
+    return urlencode(params)
+
+
+def verify_stream_query(chat_id: int, message_id: int, query: Mapping[str, str]) -> bool:
+    try:
+        if int(query.get("exp", 0)) < time():
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(query.get("sig", ""), get_signature(chat_id, message_id, query))
@@ -0,0 +1,39 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one running task.
+    The task is only cancelled once every caller waiting on it has gone.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Hashable, list] = {}
+        self.started = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        call = self.calls.get(key)
+        if call is None:
+            call = [asyncio.create_task(fn()), 0]
+            self.calls[key] = call
+            call[0].add_done_callback(lambda _: self.forget(key, call))
+            self.started += 1
+        else:
+            self.shared += 1
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                self.forget(key, call)
+                call[0].cancel()
+
+    def forget(self, key: Hashable, call: list) -> None:
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self.calls), "started": self.started, "shared": self.shared}
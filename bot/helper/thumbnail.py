@@ -1,6 +1,8 @@
 from os import path as ospath
 from bot import LOGGER
-from bot.telegram import StreamBot
+from pyrogram.file_id import FileType
+from bot.server.file_properties import choose_client, file_meta_cache
+from bot.telegram import StreamBot, multi_clients
 
 image_cache = {}
 path = ospath.join('bot/server/static', 'thumbnail.jpg')
@@ -15,8 +17,12 @@ async def get_image(chat_id, message_id):
             chat = await StreamBot.get_chat(int(chat_id))
             img = await StreamBot.download_media(str(chat.photo.big_file_id)) if chat.photo else path
         else:
-            msg = await StreamBot.get_messages(int(chat_id), int(message_id))
-            img = await StreamBot.download_media(str(msg.video.thumbs[0].file_id)) if msg.video else path
+            # the client that already holds the record from the watch page
+            index, _ = choose_client(int(chat_id), int(message_id))
+            client = multi_clients[index]
+            file_meta = await file_meta_cache.get(client, int(chat_id), int(message_id))
+            img = await client.download_media(file_meta.thumbs[0]) \
+                if file_meta.file_type == FileType.VIDEO and file_meta.thumbs else path
 
         image_cache[cache_key] = img
         return img
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from hashlib import sha256
+from typing import Dict, List, Optional, Tuple
+from pyrogram import Client, raw
+from pyrogram.crypto import aes
+from pyrogram.errors import CDNFileHashMismatch
+from pyrogram.session import Auth, Session
+
+# CDN files are verified in pieces of this size, GetCdnFileHashes returns
+# the SHA-256 of each one
+HASH_PIECE_SIZE = 128 * 1024
+MAX_REUPLOADS = 3
+CONNECT_TIMEOUT = 20
+
+
+class CdnFile:
+    """
+    Where a redirected file lives on a CDN DC, with the key it is encrypted
+    with and the piece hashes collected so far.
+    """
+    __slots__ = ("dc_id", "file_token", "encryption_key", "encryption_iv", "hashes")
+
+    def __init__(self, redirect: raw.types.upload.FileCdnRedirect):
+        self.dc_id = redirect.dc_id
+        self.file_token = redirect.file_token
+        self.encryption_key = redirect.encryption_key
+        self.encryption_iv = redirect.encryption_iv
+        self.hashes: Dict[int, bytes] = {}
+        self.add_hashes(redirect.file_hashes)
+
+    def add_hashes(self, file_hashes: List[raw.types.FileHash]) -> None:
+        for file_hash in file_hashes:
+            self.hashes[file_hash.offset] = file_hash.hash
+
+
+def decrypt_chunk(data: bytes, cdn_file: CdnFile, offset: int) -> bytes:
+    """
+    https://core.telegram.org/cdn#decrypting-files, run in an executor so
+    the event loop keeps serving other streams meanwhile
+    """
+    iv = bytearray(cdn_file.encryption_iv[:-4] + (offset // 16).to_bytes(4, "big"))
+    chunk = aes.ctr256_decrypt(data, cdn_file.encryption_key, iv)
+    for start in range(0, len(chunk), HASH_PIECE_SIZE):
+        if sha256(chunk[start:start + HASH_PIECE_SIZE]).digest() != cdn_file.hashes[offset + start]:
+            raise CDNFileHashMismatch
+    return chunk
+
+
+class CdnDownloader:
+    """
+    Follows upload.FileCdnRedirect answers. Redirects are remembered per
+    client and media so later chunks go to the CDN DC directly; a file
+    whose CDN download failed is marked and fetched from its own DC.
+    """
+
+    def __init__(self, max_files: int = 1024):
+        self.max_files = max_files
+        self.files: "OrderedDict[Tuple[str, int], Optional[CdnFile]]" = OrderedDict()
+        self.sessions: Dict[Tuple[Client, int], Session] = {}
+        self.locks: Dict[Tuple[Client, int], asyncio.Lock] = {}
+        self.unreachable = set()
+        self.redirects = 0
+        self.reuploads = 0
+        self.fallbacks = 0
+        self.fetched_bytes = 0
+
+    def get(self, client: Client, media_id: int) -> Tuple[bool, Optional[CdnFile]]:
+        """
+        (whether the CDN may be used for the file, its redirect if known)
+        """
+        key = (client.name, media_id)
+        if key not in self.files:
+            return True, None
+        self.files.move_to_end(key)
+        return self.files[key] is not None, self.files[key]
+
+    def set(self, client: Client, media_id: int, cdn_file: Optional[CdnFile]) -> None:
+        key = (client.name, media_id)
+        self.files[key] = cdn_file
+        self.files.move_to_end(key)
+        while len(self.files) > self.max_files:
+            self.files.popitem(last=False)
+
+    def redirect(self, client: Client, media_id: int, redirect: raw.types.upload.FileCdnRedirect) -> Optional[CdnFile]:
+        self.redirects += 1
+        cdn_file = CdnFile(redirect) if redirect.dc_id not in self.unreachable else None
+        self.set(client, media_id, cdn_file)
+        return cdn_file
+
+    def fall_back(self, client: Client, media_id: int, error: Exception) -> None:
+        logging.warning(f"CDN download of media {media_id} failed, using its own DC: {error!r}")
+        self.fallbacks += 1
+        self.set(client, media_id, None)
+
+    async def get_session(self, client: Client, dc_id: int) -> Session:
+        key = (client, dc_id)
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            if key not in self.sessions:
+                test_mode = await client.storage.test_mode()
+
+                async def start() -> Session:
+                    # CDN DCs need no authorization, just their own auth key
+                    auth_key = await Auth(client, dc_id, test_mode).create()
+                    session = Session(client, dc_id, auth_key, test_mode, is_media=True, is_cdn=True)
+                    await session.start()
+                    return session
+
+                try:
+                    # Session.start retries unreachable DCs forever
+                    self.sessions[key] = await asyncio.wait_for(start(), CONNECT_TIMEOUT)
+                except Exception:
+                    self.unreachable.add(dc_id)
+                    raise
+                logging.debug(f"Created CDN session for DC {dc_id}")
+        return self.sessions[key]
+
+    async def fetch(self, client: Client, session: Session, cdn_file: CdnFile, offset: int, limit: int) -> bytes:
+        """
+        download and verify a block from the CDN, `session` is the media
+        session of the file's own DC which serves reuploads and hashes
+        """
+        # hashes cover whole pieces, smaller blocks are read from the piece
+        # containing them, which never crosses the 1 MiB window either
+        piece_offset, piece_limit = (offset, limit) if limit >= HASH_PIECE_SIZE else \
+            (offset - offset % HASH_PIECE_SIZE, HASH_PIECE_SIZE)
+        cdn_session = await self.get_session(client, cdn_file.dc_id)
+        for _ in range(MAX_REUPLOADS + 1):
+            r = await cdn_session.send(raw.functions.upload.GetCdnFile(
+                file_token=cdn_file.file_token, offset=piece_offset, limit=piece_limit))
+            if not isinstance(r, raw.types.upload.CdnFileReuploadNeeded):
+                break
+            self.reuploads += 1
+            cdn_file.add_hashes(await session.send(raw.functions.upload.ReuploadCdnFile(
+                file_token=cdn_file.file_token, request_token=r.request_token)))
+        else:
+            raise TimeoutError("CDN file was not reuploaded")
+        if not r.bytes:
+            return b""
+        for start in range(piece_offset, piece_offset + len(r.bytes), HASH_PIECE_SIZE):
+            if start not in cdn_file.hashes:
+                cdn_file.add_hashes(await session.send(raw.functions.upload.GetCdnFileHashes(
+                    file_token=cdn_file.file_token, offset=start)))
+        chunk = await asyncio.get_running_loop().run_in_executor(
+            None, decrypt_chunk, r.bytes, cdn_file, piece_offset)
+        self.fetched_bytes += len(chunk)
+        return chunk[offset - piece_offset:offset - piece_offset + limit]
+
+    def stats(self) -> dict:
+        return {"files": sum(cdn_file is not None for cdn_file in self.files.values()),
+                "sessions": len(self.sessions), "redirects": self.redirects, "reuploads": self.reuploads,
+                "fallbacks": self.fallbacks, "fetched_bytes": self.fetched_bytes}
+
+
+cdn_downloader = CdnDownloader()
@@ -0,0 +1,183 @@
+import logging
+import os
+import secrets
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from aiofiles import open as aiopen
+
+from bot.config import Telegram
+from bot.server.range_planner import CHUNK_SIZE
+
+
+class ChunkCache:
+    """
+    Content-addressed on-disk cache of 1 MiB file chunks, keyed by
+    file_unique_id and chunk index and evicted least recently used first
+    once the byte budget is exceeded.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: "OrderedDict[Tuple[str, int], int]" = OrderedDict()
+        if self.enabled:
+            self.load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get_path(self, unique_id: str, index: int) -> str:
+        return os.path.join(self.path, unique_id, str(index))
+
+    def load(self) -> None:
+        """
+        rebuild the LRU order from the chunks left on disk by a previous run
+        """
+        found = []
+        os.makedirs(self.path, exist_ok=True)
+        for unique_id in os.listdir(self.path):
+            folder = os.path.join(self.path, unique_id)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if not name.isdigit():
+                    os.remove(os.path.join(folder, name))
+                    continue
+                stat = os.stat(os.path.join(folder, name))
+                found.append((stat.st_atime, unique_id, int(name), stat.st_size))
+        for _, unique_id, index, size in sorted(found):
+            self.entries[(unique_id, index)] = size
+            self.size += size
+        self.evict()
+        logging.info(f"Chunk cache loaded {len(self.entries)} chunks ({self.size} bytes)")
+
+    def __contains__(self, key: Tuple[str, int]) -> bool:
+        return key in self.entries
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "chunks": len(self.entries), "size": self.size,
+                "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+    async def get(self, unique_id: str, index: int) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        key = (unique_id, index)
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        try:
+            async with aiopen(self.get_path(unique_id, index), "rb") as f:
+                chunk = await f.read()
+        except OSError:
+            self.discard(key)
+            self.misses += 1
+            return None
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        self.hits += 1
+        return chunk
+
+    async def put(self, unique_id: str, index: int, chunk: bytes) -> None:
+        key = (unique_id, index)
+        if not self.enabled or key in self.entries or len(chunk) > self.max_size:
+            return
+        path = self.get_path(unique_id, index)
+        tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            async with aiopen(tmp_path, "wb") as f:
+                await f.write(chunk)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f"Failed to write chunk {index} of {unique_id}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        if key in self.entries:
+            return
+        self.entries[key] = len(chunk)
+        self.size += len(chunk)
+        self.evict()
+
+    def discard(self, key: Tuple[str, int]) -> None:
+        size = self.entries.pop(key, None)
+        if size is None:
+            return
+        self.size -= size
+        try:
+            os.remove(self.get_path(*key))
+        except OSError:
+            pass
+
+    def evict(self) -> None:
+        while self.size > self.max_size and self.entries:
+            key = next(iter(self.entries))
+            self.discard(key)
+            logging.debug(f"Evicted chunk {key[1]} of {key[0]} from chunk cache")
+
+
+class HotChunkCache:
+    """
+    In-memory tier in front of ChunkCache that only admits the chunks
+    players probe first: file heads, file tails and seek targets.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, unique_id: str, index: int) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        key = (unique_id, index)
+        if (chunk := self.entries.get(key)) is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return chunk
+
+    def put(self, unique_id: str, index: int, chunk: bytes) -> None:
+        key = (unique_id, index)
+        if not self.enabled or key in self.entries or len(chunk) > self.max_size:
+            return
+        self.entries[key] = chunk
+        self.size += len(chunk)
+        while self.size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "chunks": len(self.entries), "size": self.size,
+                "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+chunk_cache = ChunkCache(Telegram.CHUNK_CACHE_DIR, Telegram.CHUNK_CACHE_SIZE * 1024 * 1024)
+hot_cache = HotChunkCache(Telegram.HOT_CACHE_SIZE * 1024 * 1024)
+
+
+async def read_cached_range(unique_id: str, from_bytes: int, until_bytes: int) -> Optional[bytes]:
+    """
+    the inclusive byte range if every chunk it touches is cached in RAM or
+    on disk, without going to Telegram
+    """
+    data = []
+    for index in range(from_bytes // CHUNK_SIZE, until_bytes // CHUNK_SIZE + 1):
+        if (chunk := hot_cache.get(unique_id, index)) is None:
+            if (unique_id, index) not in chunk_cache or (chunk := await chunk_cache.get(unique_id, index)) is None:
+                return None
+        data.append(chunk)
+    start = from_bytes - from_bytes // CHUNK_SIZE * CHUNK_SIZE
+    return b"".join(data)[start:start + until_bytes - from_bytes + 1]
@@ -1,106 +1,212 @@
 import asyncio
 import logging
+from collections import deque
+from time import monotonic
 from pyrogram import utils, raw
-from pyrogram.errors import AuthBytesInvalid
+from pyrogram.errors import FileReferenceExpired, FloodWait, InternalServerError, ServiceUnavailable
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
-from pyrogram.session import Session, Auth
-from typing import Dict, Union
-from bot.helper.exceptions import FIleNotFound
-from bot.server.file_properties import get_file_ids
-from bot.telegram import work_loads
+from pyrogram.session import Session
+from typing import Dict, List, Optional, Tuple, Union
+from bot.config import Telegram
+from bot.helper.singleflight import SingleFlight
+from bot.server.cdn import cdn_downloader
+from bot.server.chunk_cache import chunk_cache, hot_cache
+from bot.server.file_properties import FileMeta, file_meta_cache
+from bot.server.media_session import get_session_pool
+from bot.server.range_planner import CHUNK_SIZE, plan_range
+from bot.server.scheduler import INTERACTIVE_BLOCKS, PRIORITY_INTERACTIVE, PRIORITY_STREAM, TokenBucket, \
+    upstream_scheduler
+from bot.telegram import multi_clients, work_loads
+from bot.telegram.client_pool import client_pool
 from pyrogram import Client, utils, raw
 
 
+chunk_flights = SingleFlight()
+stream_stats = {"reference_refreshes": 0, "retries": 0, "aborted_streams": 0, "cancelled_fetches": 0,
+                "undelivered_bytes": 0, "head_requests": 0, "cached_probes": 0, "uncached_probes": 0,
+                "rejected_links": 0}
+
+
+class StreamSource:
+    """
+    One client taking part in a stream, with the media session and file
+    location it downloads through.
+    """
+    __slots__ = ("index", "streamer", "file_meta", "session", "location")
+
+    def __init__(self, index: int, streamer: "ByteStreamer", file_meta: FileMeta, session: Session, location):
+        self.index = index
+        self.streamer = streamer
+        self.file_meta = file_meta
+        self.session = session
+        self.location = location
+
+    async def refresh(self) -> None:
+        self.file_meta = await file_meta_cache.refresh(self.streamer.client, self.file_meta)
+        self.location = await self.streamer.get_location(self.file_meta)
+        stream_stats["reference_refreshes"] += 1
+        logging.debug(f"Refreshed file reference of message {self.file_meta.message_id} for client {self.index}")
+
+
 class ByteStreamer:
     def __init__(self, client: Client):
-        self.clean_timer = 30 * 60
         self.client: Client = client
-        self.__cached_file_ids: Dict[int, FileId] = {}
-        asyncio.create_task(self.clean_cache())
-
-    async def get_file_properties(self, chat_id: int, message_id: int) -> FileId:
-        if message_id not in self.__cached_file_ids:
-            file_id = await get_file_ids(self.client, int(chat_id), int(message_id))
-            if not file_id:
-                logging.info('Message with ID %s not found!', message_id)
-                raise FIleNotFound
-            self.__cached_file_ids[message_id] = file_id
-        return self.__cached_file_ids[message_id]
-
-    async def yield_file(self, file_id: FileId, index: int, offset: int, first_part_cut: int, last_part_cut: int, part_count: int, chunk_size: int) -> Union[str, None]: # type: ignore
+
+    async def get_file_properties(self, chat_id: int, message_id: int) -> FileMeta:
+        return await file_meta_cache.get(self.client, chat_id, message_id)
+
+    async def yield_file(self, file_id: FileMeta, index: int, from_bytes: int, until_bytes: int, stripes: List[Tuple["ByteStreamer", FileMeta, int]] = (), priority: int = PRIORITY_STREAM, bucket: Optional[TokenBucket] = None) -> Union[str, None]: # type: ignore
         client = self.client
+        sources: List[StreamSource] = []
+        blocks = []
+        pending = deque()
+        next_part = 0
+        current_part = 0
+        undelivered = 0
         work_loads[index] += 1
         logging.debug(f"Starting to yielding file with client {index}.")
-        media_session = await self.generate_media_session(client, file_id)
-        current_part = 1
-        location = await self.get_location(file_id)
         try:
-            r = await media_session.send(raw.functions.upload.GetFile(location=location, offset=offset, limit=chunk_size))
-            if isinstance(r, raw.types.upload.File):
-                while True:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    elif part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                    elif current_part == 1:
-                        yield chunk[first_part_cut:]
-                    elif current_part == part_count:
-                        yield chunk[:last_part_cut]
-                    else:
-                        yield chunk
-
-                    current_part += 1
-                    offset += chunk_size
-
-                    if current_part > part_count:
-                        break
-
-                    r = await media_session.send(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
-                    )
+            media_session = await self.generate_media_session(client, file_id)
+            sources.append(StreamSource(index, self, file_id, media_session, await self.get_location(file_id)))
+            for streamer, stripe_file_id, stripe_index in stripes:
+                try:
+                    stripe_session = await streamer.generate_media_session(streamer.client, stripe_file_id)
+                    stripe_location = await streamer.get_location(stripe_file_id)
+                except Exception as e:
+                    logging.debug(f"Skipping client {stripe_index} for striping: {e}")
+                    continue
+                work_loads[stripe_index] += 1
+                sources.append(StreamSource(stripe_index, streamer, stripe_file_id, stripe_session, stripe_location))
+            if len(sources) > 1:
+                logging.debug(f"Striping file across clients {[source.index for source in sources]}.")
+            blocks = plan_range(from_bytes, until_bytes)
+            for part, (_, limit) in enumerate(blocks):
+                client_pool.acquire(sources[part % len(sources)].index, limit)
+            # chunks waiting to be written plus the ones being fetched, bounded
+            # so a slow reader never holds more than STREAM_BUFFER_SIZE MB
+            window = max(1, min(Telegram.PREFETCH_CHUNKS * len(sources), Telegram.STREAM_BUFFER_SIZE))
+            while current_part < len(blocks):
+                # keep up to `window` GetFile requests in flight so the next
+                # chunks are already travelling while this one is written out
+                while len(pending) < window and next_part < len(blocks):
+                    offset, limit = blocks[next_part]
+                    # the first chunk of a request is the file head or a seek
+                    # target, players also probe the tail before playing
+                    hot = next_part == 0 or offset + limit >= file_id.file_size
+                    part_priority = PRIORITY_INTERACTIVE if next_part < INTERACTIVE_BLOCKS else priority
+                    pending.append(asyncio.create_task(
+                        self.get_chunk(sources[next_part % len(sources)], file_id.unique_id, offset, limit, hot,
+                                       part_priority)))
+                    next_part += 1
+
+                chunk = await pending.popleft()
+                if not chunk:
+                    break
+                offset, limit = blocks[current_part]
+                client_pool.release(sources[current_part % len(sources)].index, limit)
+                # a view instead of a slice, the 1 MiB chunk is not copied
+                chunk = memoryview(chunk)[max(from_bytes - offset, 0):until_bytes + 1 - offset]
+                undelivered = len(chunk)
+                if bucket:
+                    await bucket.take(len(chunk))
+                yield chunk
+                undelivered = 0
+                current_part += 1
         except (TimeoutError, AttributeError):
             pass
         finally:
-            logging.debug("Finished yielding file with {current_part} parts.")
+            if current_part < len(blocks):
+                # the viewer left or the stream failed, count what was already
+                # downloaded for it and stop the rest right away
+                stream_stats["aborted_streams"] += 1
+                stream_stats["undelivered_bytes"] += undelivered + sum(
+                    len(task.result()) for task in pending
+                    if task.done() and not task.cancelled() and task.exception() is None)
+                stream_stats["cancelled_fetches"] += sum(not task.done() for task in pending)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            logging.debug(f"Finished yielding file with {current_part} parts.")
+            for part in range(current_part, len(blocks)):
+                client_pool.release(sources[part % len(sources)].index, blocks[part][1])
             work_loads[index] -= 1
+            for source in sources[1:]:
+                work_loads[source.index] -= 1
+
+    async def get_chunk(self, source: StreamSource, unique_id: str, offset: int, limit: int, hot: bool = False,
+                        priority: int = PRIORITY_STREAM) -> bytes:
+        index, start = divmod(offset, CHUNK_SIZE)
+        if (chunk := hot_cache.get(unique_id, index)) is not None:
+            return chunk[start:start + limit]
+        for attempt in range(Telegram.STREAM_RETRIES + 1):
+            try:
+                chunk = await chunk_flights.do(
+                    (unique_id, offset, limit),
+                    lambda: self.load_chunk(unique_id, source, offset, limit, priority))
+                break
+            except FileReferenceExpired:
+                # long playbacks outlive file references, fetch a fresh one
+                # and resume from the same offset
+                if attempt == Telegram.STREAM_RETRIES:
+                    raise
+                await source.refresh()
+            except FloodWait as e:
+                client_pool.flood_wait(source.index, e.value)
+                if attempt == Telegram.STREAM_RETRIES or e.value > Telegram.SLEEP_THRESHOLD:
+                    raise
+                stream_stats["retries"] += 1
+                await asyncio.sleep(e.value)
+            except (InternalServerError, ServiceUnavailable, TimeoutError, OSError) as e:
+                if attempt == Telegram.STREAM_RETRIES:
+                    raise
+                stream_stats["retries"] += 1
+                logging.debug(f"Retrying chunk at {offset} of {unique_id} after {e!r}")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        if chunk and hot and limit == CHUNK_SIZE:
+            hot_cache.put(unique_id, index, chunk)
+        return chunk
+
+    async def load_chunk(self, unique_id: str, source: StreamSource, offset: int, limit: int,
+                         priority: int = PRIORITY_STREAM) -> bytes:
+        # both cache tiers hold whole 1 MiB chunks, smaller planner blocks
+        # are served from them when present but never stored
+        index, start = divmod(offset, CHUNK_SIZE)
+        if (chunk := await chunk_cache.get(unique_id, index)) is not None:
+            return chunk[start:start + limit]
+        await upstream_scheduler.acquire(priority, limit)
+        try:
+            started = monotonic()
+            chunk = await self.fetch_chunk(source, offset, limit)
+        finally:
+            upstream_scheduler.release()
+        client_pool.record(source.index, source.file_meta.dc_id, len(chunk), monotonic() - started)
+        if chunk and limit == CHUNK_SIZE:
+            await chunk_cache.put(unique_id, index, chunk)
+        return chunk
+
+    async def fetch_chunk(self, source: StreamSource, offset: int, limit: int) -> bytes:
+        media_id = source.file_meta.media_id
+        cdn_supported, cdn_file = cdn_downloader.get(self.client, media_id)
+        if cdn_file:
+            try:
+                return await cdn_downloader.fetch(self.client, source.session, cdn_file, offset, limit)
+            except Exception as e:
+                # the CDN is only a shortcut, the file's own DC still has it
+                cdn_downloader.fall_back(self.client, media_id, e)
+                cdn_supported = False
+        r = await source.session.send(
+            raw.functions.upload.GetFile(location=source.location, offset=offset, limit=limit,
+                                         cdn_supported=Telegram.CDN_DOWNLOADS and cdn_supported)
+        )
+        if isinstance(r, raw.types.upload.File):
+            return r.bytes
+        if isinstance(r, raw.types.upload.FileCdnRedirect):
+            cdn_downloader.redirect(self.client, media_id, r)
+            return await self.fetch_chunk(source, offset, limit)
+        return b""
 
     async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
-        media_session = client.media_sessions.get(file_id.dc_id, None)
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                media_session = Session(client,
-                                        file_id.dc_id,
-                                        await Auth(client, file_id.dc_id, await client.storage.test_mode()).create(),
-                                        await client.storage.test_mode(),
-                                        is_media=True)
-                await media_session.start()
-                for _ in range(6):
-                    exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id))
-                    try:
-                        await media_session.send(raw.functions.auth.ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes))
-                        break
-                    except AuthBytesInvalid:
-                        logging.debug(
-                            'Invalid authorization bytes for DC %s!', file_id.dc_id)
-                        continue
-                else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
-            else:
-                media_session = Session(client,
-                                        file_id.dc_id,
-                                        await client.storage.auth_key(),
-                                        await client.storage.test_mode(),
-                                        is_media=True)
-                await media_session.start()
-            logging.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
-        else:
-            logging.debug(f"Using cached media session for DC {file_id.dc_id}")
-        return media_session
+        return await get_session_pool(client).get(file_id.dc_id)
 
     @staticmethod
     async def get_location(file_id: FileId) -> Union[raw.types.InputPhotoFileLocation, raw.types.InputDocumentFileLocation, raw.types.InputPeerPhotoFileLocation]:
@@ -131,11 +237,17 @@ class ByteStreamer:
                                                            thumb_size=file_id.thumbnail_size)
         return location
 
-    async def clean_cache(self) -> None:
-        """
-        function to clean the cache to reduce memory usage
-        """
-        while True:
-            await asyncio.sleep(self.clean_timer)
-            self.__cached_file_ids.clear()
-            logging.debug("Cleaned the cache")
+
+class_cache = {}
+
+
+def get_byte_streamer(index: int) -> ByteStreamer:
+    faster_client = multi_clients[index]
+    if faster_client in class_cache:
+        tg_connect = class_cache[faster_client]
+        logging.debug(f"Using cached ByteStreamer object for client {index}")
+    else:
+        logging.debug(f"Creating new ByteStreamer object for client {index}")
+        tg_connect = ByteStreamer(faster_client)
+        class_cache[faster_client] = tg_connect
+    return tg_connect
@@ -1,20 +1,206 @@
-from pyrogram.file_id import FileId
-from typing import Optional
+import asyncio
+import json
+import logging
+import os
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from time import time
+from pyrogram.file_id import FileId, FileType
+from typing import List, Optional, Tuple
+from bot.config import Telegram
 from bot.helper.exceptions import FIleNotFound
 from bot.helper.media import is_media
+from bot.helper.singleflight import SingleFlight
+from bot.telegram import multi_clients
+from bot.telegram.client_pool import client_pool
 from pyrogram import Client
 
 
-async def get_file_ids(client: Client, chat_id: int, message_id: int) -> Optional[FileId]:
+class FileMeta:
+    """
+    Compact record of everything needed to stream a message's media and
+    render its watch page. The attribute names mirror FileId so it can be
+    used wherever one is expected.
+    """
+    __slots__ = ("chat_id", "message_id", "dc_id", "file_type", "media_id", "access_hash", "file_reference",
+                 "thumbnail_size", "file_size", "mime_type", "file_name", "unique_id", "date", "caption",
+                 "duration", "thumbs")
+
+    def __init__(self, chat_id: int, message_id: int, dc_id: int, file_type: FileType, media_id: int,
+                 access_hash: int, file_reference: bytes, thumbnail_size: str, file_size: int, mime_type: str,
+                 file_name: str, unique_id: str, date: int, caption: str = "", duration: int = 0,
+                 thumbs: List[str] = ()):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.dc_id = dc_id
+        self.file_type = file_type
+        self.media_id = media_id
+        self.access_hash = access_hash
+        self.file_reference = file_reference
+        self.thumbnail_size = thumbnail_size
+        self.file_size = file_size
+        self.mime_type = mime_type
+        self.file_name = file_name
+        self.unique_id = unique_id
+        self.date = date
+        self.caption = caption
+        self.duration = duration
+        self.thumbs = list(thumbs)
+
+    @classmethod
+    def from_message(cls, message) -> "FileMeta":
+        if not (media := is_media(message)):
+            raise FIleNotFound
+        file_id = FileId.decode(media.file_id)
+        date = message.edit_date or message.date
+        return cls(
+            chat_id=message.chat.id,
+            message_id=message.id,
+            dc_id=file_id.dc_id,
+            file_type=file_id.file_type,
+            media_id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumbnail_size=file_id.thumbnail_size,
+            file_size=getattr(media, 'file_size', 0),
+            mime_type=getattr(media, 'mime_type', ''),
+            file_name=getattr(media, 'file_name', ''),
+            unique_id=media.file_unique_id,
+            date=int(date.timestamp()) if date else 0,
+            caption=message.caption or "",
+            duration=int(getattr(media, 'duration', 0) or 0),
+            thumbs=[thumb.file_id for thumb in getattr(media, 'thumbs', None) or []],
+        )
+
+    def to_dict(self) -> dict:
+        data = {slot: getattr(self, slot) for slot in self.__slots__}
+        data["file_type"] = int(self.file_type)
+        data["file_reference"] = b64encode(self.file_reference).decode()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FileMeta":
+        data = dict(data)
+        data["file_type"] = FileType(data["file_type"])
+        data["file_reference"] = b64decode(data["file_reference"])
+        return cls(**data)
+
+
+async def get_file_ids(client: Client, chat_id: int, message_id: int) -> Optional[FileMeta]:
     message = await client.get_messages(chat_id, message_id)
     if message.empty:
         raise FIleNotFound
-    file_id = file_unique_id = None
-    if media := is_media(message):
-        file_id, file_unique_id = FileId.decode(
-            media.file_id), media.file_unique_id
-    setattr(file_id, 'file_name', getattr(media, 'file_name', ''))
-    setattr(file_id, 'file_size', getattr(media, 'file_size', 0))
-    setattr(file_id, 'mime_type', getattr(media, 'mime_type', ''))
-    setattr(file_id, 'unique_id', file_unique_id)
-    return file_id
+    return FileMeta.from_message(message)
+
+
+class FileMetaCache:
+    """
+    LRU cache of FileMeta records shared by every client, keyed by
+    (client, chat_id, message_id) since file references are per bot.
+    Entries expire one by one after `ttl` seconds and the cache can be
+    saved to disk so a restart doesn't refetch every message.
+    """
+
+    def __init__(self, max_entries: int, ttl: int, path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.entries: "OrderedDict[Tuple[str, int, int], Tuple[float, FileMeta]]" = OrderedDict()
+        self.flights = SingleFlight()
+        if self.path:
+            self.load()
+
+    async def get(self, client: Client, chat_id: int, message_id: int) -> FileMeta:
+        key = (client.name, int(chat_id), int(message_id))
+        if (entry := self.entries.get(key)) is not None:
+            if entry[0] > time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+        self.misses += 1
+        file_meta = await self.flights.do(key, lambda: get_file_ids(client, int(chat_id), int(message_id)))
+        self.put(key, file_meta)
+        return file_meta
+
+    def peek(self, client: Client, chat_id: int, message_id: int) -> Optional[FileMeta]:
+        """
+        cached record without a Telegram lookup, even if it has expired
+        """
+        entry = self.entries.get((client.name, int(chat_id), int(message_id)))
+        return entry[1] if entry else None
+
+    def put(self, key: Tuple[str, int, int], file_meta: FileMeta) -> None:
+        self.entries[key] = (time() + self.ttl, file_meta)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    async def refresh(self, client: Client, stale: FileMeta) -> FileMeta:
+        """
+        fetch a new file reference for a record whose reference expired,
+        concurrent callers holding the same stale record share one lookup
+        """
+        key = (client.name, stale.chat_id, stale.message_id)
+        if (entry := self.entries.get(key)) is not None and entry[1].file_reference != stale.file_reference:
+            return entry[1]
+        self.entries.pop(key, None)
+        return await self.get(client, stale.chat_id, stale.message_id)
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            now = time()
+            for client_name, chat_id, message_id, expires_at, file_meta in data:
+                if expires_at > now:
+                    self.entries[(client_name, chat_id, message_id)] = (expires_at, FileMeta.from_dict(file_meta))
+            logging.info(f"Loaded {len(self.entries)} cached file properties")
+        except Exception as e:
+            logging.error(f"Failed to load file properties cache: {e}")
+
+    def save(self) -> None:
+        if not self.path or not self.dirty:
+            return
+        data = [[*key, expires_at, file_meta.to_dict()] for key, (expires_at, file_meta) in self.entries.items()]
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(f"{self.path}.tmp", self.path)
+            self.dirty = False
+        except OSError as e:
+            logging.error(f"Failed to save file properties cache: {e}")
+
+    async def autosave(self, interval: int = 300) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.save()
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "max_entries": self.max_entries,
+                "hits": self.hits, "misses": self.misses}
+
+
+file_meta_cache = FileMetaCache(Telegram.FILE_META_CACHE_SIZE, Telegram.FILE_META_CACHE_TTL,
+                                Telegram.FILE_META_CACHE_FILE)
+
+
+def choose_client(chat_id: int, message_id: int, size: int = 0) -> Tuple[int, Optional[FileMeta]]:
+    """
+    the client to use for a message and any cached record of it; clients
+    that already hold the record come first so the watch page, its
+    thumbnail and the stream share a single Telegram lookup
+    """
+    cached = {index: file_meta for index, client in multi_clients.items()
+              if (file_meta := file_meta_cache.peek(client, chat_id, message_id))}
+    known = next(iter(cached.values()), None)
+    ranked = client_pool.rank(known.dc_id if known else None, size or (known.file_size if known else 0))
+    holders = [index for index in ranked if index in cached and client_pool.is_available(index)]
+    return (holders or ranked)[0], known
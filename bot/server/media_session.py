@@ -0,0 +1,172 @@
+import asyncio
+import logging
+from itertools import count
+from pyrogram import Client, raw
+from pyrogram.errors import AuthBytesInvalid
+from pyrogram.session import Session, Auth
+from typing import Dict, List
+from bot.config import Telegram
+
+DC_IDS = (1, 2, 3, 4, 5)
+# seconds a media session may take to connect
+CONNECT_TIMEOUT = 20
+
+
+class MediaSessionPool:
+    """
+    Keeps several ready media sessions per DC for one client so concurrent
+    streams don't queue on a single MTProto connection. Sessions to foreign
+    DCs share one exported authorization, which is only imported once.
+    """
+
+    def __init__(self, client: Client, size: int):
+        self.client = client
+        self.size = max(1, size)
+        self.sessions: Dict[int, List[Session]] = {}
+        self.auth_keys: Dict[int, bytes] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.counter = count()
+        self.replaced = 0
+        self.keep_alive_task = None
+        self.closed = False
+
+    async def get(self, dc_id: int) -> Session:
+        sessions = self.sessions.get(dc_id)
+        if not sessions:
+            async with self.locks.setdefault(dc_id, asyncio.Lock()):
+                if not (sessions := self.sessions.get(dc_id)):
+                    sessions = self.sessions[dc_id] = [await self.create(dc_id)]
+            if self.size > 1:
+                # the viewer only waits for the first session
+                asyncio.create_task(self.fill(dc_id))
+        return sessions[next(self.counter) % len(sessions)]
+
+    async def get_auth_key(self, dc_id: int) -> bytes:
+        if dc_id == await self.client.storage.dc_id():
+            return await self.client.storage.auth_key()
+        if dc_id not in self.auth_keys:
+            auth_key = await Auth(self.client, dc_id, await self.client.storage.test_mode()).create()
+            session = await self.start_session(dc_id, auth_key)
+            try:
+                for _ in range(6):
+                    exported_auth = await self.client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                    try:
+                        await session.send(raw.functions.auth.ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes))
+                        break
+                    except AuthBytesInvalid:
+                        logging.debug('Invalid authorization bytes for DC %s!', dc_id)
+                        continue
+                else:
+                    raise AuthBytesInvalid
+            finally:
+                await session.stop()
+            self.auth_keys[dc_id] = auth_key
+        return self.auth_keys[dc_id]
+
+    async def start_session(self, dc_id: int, auth_key: bytes) -> Session:
+        session = Session(self.client, dc_id, auth_key, await self.client.storage.test_mode(), is_media=True)
+        try:
+            # Session.start retries unreachable DCs forever, while fill()
+            # holds the DC's lock and every viewer of the DC waits on it
+            await asyncio.wait_for(session.start(), CONNECT_TIMEOUT)
+        except BaseException:
+            await self.stop_session(session)
+            raise
+        return session
+
+    @staticmethod
+    async def stop_session(session: Session) -> None:
+        try:
+            await session.stop()
+        except Exception:
+            pass
+
+    async def create(self, dc_id: int) -> Session:
+        session = await self.start_session(dc_id, await self.get_auth_key(dc_id))
+        logging.debug(f"Created media session for DC {dc_id}")
+        return session
+
+    async def fill(self, dc_id: int) -> None:
+        async with self.locks.setdefault(dc_id, asyncio.Lock()):
+            # a fill scheduled by get() may only run after stop()
+            if self.closed:
+                return
+            sessions = self.sessions.setdefault(dc_id, [])
+            while len(sessions) < self.size:
+                try:
+                    sessions.append(await self.create(dc_id))
+                except Exception as e:
+                    logging.error(f"Failed to create media session for DC {dc_id}: {e!r}")
+                    break
+
+    async def warm_up(self) -> None:
+        for dc_id in DC_IDS:
+            await self.fill(dc_id)
+        logging.info(f"Media sessions ready for {self.client.name}: "
+                     f"{ {dc_id: len(sessions) for dc_id, sessions in self.sessions.items()} }")
+
+    async def is_alive(self, session: Session) -> bool:
+        if not session.is_started.is_set():
+            return False
+        try:
+            await session.send(raw.functions.Ping(ping_id=0), timeout=10)
+            return True
+        except Exception:
+            return False
+
+    async def health_check(self) -> None:
+        for dc_id, sessions in list(self.sessions.items()):
+            for session in list(sessions):
+                if await self.is_alive(session):
+                    continue
+                logging.warning(f"Replacing dead media session for DC {dc_id} of {self.client.name}")
+                sessions.remove(session)
+                self.replaced += 1
+                await self.stop_session(session)
+            await self.fill(dc_id)
+
+    async def keep_alive(self, interval: int = 60) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.health_check()
+            except Exception as e:
+                logging.error(f"Media session health check failed for {self.client.name}: {e}")
+
+    async def stop(self) -> None:
+        """
+        stop every pooled session, the client doesn't know about them
+        """
+        self.closed = True
+        if self.keep_alive_task:
+            self.keep_alive_task.cancel()
+        for sessions in self.sessions.values():
+            for session in sessions:
+                await self.stop_session(session)
+        self.sessions.clear()
+
+    def stats(self) -> dict:
+        return {"sessions": {dc_id: len(sessions) for dc_id, sessions in self.sessions.items()},
+                "replaced": self.replaced}
+
+
+session_pools: Dict[Client, MediaSessionPool] = {}
+
+
+def get_session_pool(client: Client) -> MediaSessionPool:
+    if client not in session_pools:
+        session_pools[client] = MediaSessionPool(client, Telegram.MEDIA_SESSIONS_PER_DC)
+    return session_pools[client]
+
+
+async def start_session_pools(clients: List[Client]) -> None:
+    for client in clients:
+        pool = get_session_pool(client)
+        pool.keep_alive_task = asyncio.create_task(pool.keep_alive())
+        if Telegram.MEDIA_SESSION_WARM_UP:
+            await pool.warm_up()
+
+
+async def stop_session_pools() -> None:
+    for pool in session_pools.values():
+        await pool.stop()
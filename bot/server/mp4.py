@@ -0,0 +1,198 @@
+import logging
+import struct
+import sys
+from array import array
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import AsyncGenerator, Awaitable, Callable, List, Optional, Tuple, Union
+
+from bot.config import Telegram
+from bot.helper.singleflight import SingleFlight
+
+MP4_MIME_TYPES = ("video/mp4", "video/quicktime", "video/x-m4v", "audio/mp4", "audio/x-m4a")
+# boxes on the way from moov to the chunk offset tables
+CONTAINER_BOXES = (b"moov", b"trak", b"mdia", b"minf", b"stbl")
+MAX_TOP_LEVEL_BOXES = 32
+
+Reader = Callable[[int, int], Awaitable[bytes]]
+
+
+class Mp4Layout:
+    """
+    Top-level box index of an MP4 file. When moov sits after mdat it also
+    describes a virtual fast-start copy of the same size: the boxes before
+    mdat, then moov with its chunk offsets shifted, then the rest of the
+    file, as a list of (virtual_start, length, source) segments where the
+    source is an upstream offset or bytes held in memory.
+    """
+    __slots__ = ("boxes", "file_size", "moov", "segments")
+
+    def __init__(self, boxes: List[Tuple[bytes, int, int]], file_size: int, moov: Optional[bytes] = None):
+        self.boxes = boxes
+        self.file_size = file_size
+        self.moov = moov
+        self.segments: List[Tuple[int, int, Union[int, bytes]]] = []
+        if moov is None:
+            return
+        offsets = {kind: offset for kind, offset, _ in reversed(boxes)}
+        insert_at = next(offset for kind, offset, _ in boxes if kind not in (b"ftyp", b"styp"))
+        moov_offset = offsets[b"moov"]
+        self.segments = [
+            (0, insert_at, 0),
+            (insert_at, len(moov), moov),
+            (insert_at + len(moov), moov_offset - insert_at, insert_at),
+            (moov_offset + len(moov), file_size - moov_offset - len(moov), moov_offset + len(moov)),
+        ]
+
+    @property
+    def is_virtual(self) -> bool:
+        return bool(self.segments)
+
+    @property
+    def size(self) -> int:
+        return len(self.moov or b"")
+
+    def map_range(self, from_bytes: int, until_bytes: int) -> List[Union[Tuple[int, int], memoryview]]:
+        """
+        pieces of the virtual range: inclusive upstream ranges or moov bytes
+        """
+        pieces = []
+        for start, length, source in self.segments:
+            first, last = max(from_bytes, start), min(until_bytes, start + length - 1)
+            if first > last:
+                continue
+            if isinstance(source, bytes):
+                pieces.append(memoryview(source)[first - start:last - start + 1])
+            else:
+                pieces.append((source + first - start, source + last - start))
+        return pieces
+
+    async def read(self, read_range: Callable[[int, int], AsyncGenerator], from_bytes: int,
+                   until_bytes: int) -> AsyncGenerator:
+        for piece in self.map_range(from_bytes, until_bytes):
+            if isinstance(piece, memoryview):
+                yield piece
+                continue
+            async with aclosing(read_range(*piece)) as body:
+                async for chunk in body:
+                    yield chunk
+
+
+def read_box_header(data: bytes, offset: int, end: int) -> Tuple[bytes, int, int]:
+    """
+    (type, header length, box size) of the box starting at `offset`
+    """
+    size, kind = struct.unpack_from(">I4s", data, offset)
+    header = 8
+    if size == 1:
+        size, header = struct.unpack_from(">Q", data, offset + 8)[0], 16
+    elif size == 0:
+        size = end - offset
+    if size < header or offset + size > end:
+        raise ValueError(f"Invalid {kind!r} box at {offset}")
+    return kind, header, size
+
+
+def shift_chunk_offsets(moov: bytearray, moved: range, delta: int, start: int = 0, end: Optional[int] = None) -> None:
+    """
+    add `delta` to the stco/co64 entries pointing into `moved`, in place,
+    OverflowError if a 32 bit table can't hold the new offsets
+    """
+    end = len(moov) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        kind, header, size = read_box_header(moov, offset, end)
+        if kind in CONTAINER_BOXES:
+            shift_chunk_offsets(moov, moved, delta, offset + header, offset + size)
+        elif kind in (b"stco", b"co64"):
+            entries = array("I" if kind == b"stco" else "Q")
+            count = struct.unpack_from(">I", moov, offset + header + 4)[0]
+            table = offset + header + 8
+            if table + count * entries.itemsize > offset + size:
+                raise ValueError(f"Truncated {kind!r} box at {offset}")
+            entries.frombytes(moov[table:table + count * entries.itemsize])
+            if sys.byteorder == "little":
+                entries.byteswap()
+            shifted = [value + delta if value in moved else value for value in entries]
+            if kind == b"stco" and shifted and max(shifted) > 0xFFFFFFFF:
+                raise OverflowError("Chunk offsets don't fit in stco")
+            entries = array(entries.typecode, shifted)
+            if sys.byteorder == "little":
+                entries.byteswap()
+            moov[table:table + count * entries.itemsize] = entries.tobytes()
+        offset += size
+
+
+async def build_layout(file_size: int, read: Reader, max_moov_size: int) -> Optional[Mp4Layout]:
+    boxes = []
+    offset = 0
+    while offset + 8 <= file_size and len(boxes) < MAX_TOP_LEVEL_BOXES:
+        header = await read(offset, min(offset + 16, file_size) - 1)
+        kind, _, size = read_box_header(header.ljust(16, b"\0"), 0, file_size - offset)
+        if not boxes and kind not in (b"ftyp", b"styp"):
+            return None
+        boxes.append((kind, offset, size))
+        offset += size
+    kinds = [kind for kind, _, _ in boxes]
+    if b"moov" not in kinds or b"mdat" not in kinds or kinds.index(b"moov") < kinds.index(b"mdat"):
+        # already fast-start, or not something we can rearrange
+        return Mp4Layout(boxes, file_size)
+    _, moov_offset, moov_size = boxes[kinds.index(b"moov")]
+    if moov_size > max_moov_size:
+        return Mp4Layout(boxes, file_size)
+    moov = bytearray(await read(moov_offset, moov_offset + moov_size - 1))
+    kind, header, _ = read_box_header(moov, 0, len(moov))
+    # everything between the leading ftyp and moov moves up by moov's size,
+    # data stored after moov keeps its place
+    insert_at = next(offset for kind, offset, _ in boxes if kind not in (b"ftyp", b"styp"))
+    try:
+        shift_chunk_offsets(moov, range(insert_at, moov_offset), moov_size, header)
+    except OverflowError:
+        return Mp4Layout(boxes, file_size)
+    return Mp4Layout(boxes, file_size, bytes(moov))
+
+
+class Mp4IndexCache:
+    """
+    Layouts by file_unique_id, evicted least recently used first once the
+    moov boxes they hold exceed `max_size` bytes. Files that aren't MP4
+    are remembered as None so they are only probed once.
+    """
+
+    def __init__(self, max_size: int, max_entries: int = 4096):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.size = 0
+        self.virtual = 0
+        self.entries: "OrderedDict[str, Optional[Mp4Layout]]" = OrderedDict()
+        self.flights = SingleFlight()
+
+    async def get(self, unique_id: str, file_size: int, read: Reader) -> Optional[Mp4Layout]:
+        if unique_id in self.entries:
+            self.entries.move_to_end(unique_id)
+            return self.entries[unique_id]
+        try:
+            layout = await self.flights.do(unique_id, lambda: build_layout(file_size, read, self.max_size))
+        except (ValueError, struct.error) as e:
+            logging.debug(f"Can't index MP4 boxes of {unique_id}: {e}")
+            layout = None
+        self.put(unique_id, layout)
+        return layout
+
+    def put(self, unique_id: str, layout: Optional[Mp4Layout]) -> None:
+        if unique_id in self.entries:
+            return
+        self.entries[unique_id] = layout
+        self.size += layout.size if layout else 0
+        self.virtual += bool(layout and layout.is_virtual)
+        while self.size > self.max_size or len(self.entries) > self.max_entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size if evicted else 0
+            self.virtual -= bool(evicted and evicted.is_virtual)
+
+    def stats(self) -> dict:
+        return {"files": len(self.entries), "faststart": self.virtual, "size": self.size,
+                "max_size": self.max_size}
+
+
+mp4_index = Mp4IndexCache(Telegram.MP4_INDEX_CACHE_SIZE * 1024 * 1024)
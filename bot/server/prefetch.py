@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from time import time
+from typing import Dict, List, Tuple
+
+from bot.config import Telegram
+from bot.helper.exceptions import FIleNotFound
+from bot.server.chunk_cache import chunk_cache, hot_cache
+from bot.server.custom_dl import StreamSource, get_byte_streamer
+from bot.server.file_properties import choose_client
+from bot.server.range_planner import CHUNK_SIZE
+from bot.server.scheduler import PRIORITY_BULK, new_bucket
+
+# a file warmed this recently is not warmed again
+WARM_TTL = 600
+MAX_TRACKED = 4096
+
+
+class Prefetcher:
+    """
+    Warms up what a viewer is about to play when the watch page is
+    rendered: the file properties, a media session to the file's DC and the
+    first and last chunks, plus the head of the next message which in a
+    series is usually the next episode. Chunk downloads draw from a token
+    bucket and are skipped, not delayed, when it runs dry.
+    """
+
+    def __init__(self, budget_kb: int, concurrency: int = 2):
+        self.budget = new_bucket(budget_kb)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # (chat_id, message_id) -> when it was warmed
+        self.warmed = OrderedDict()
+        # unique_id -> prefetched chunk indexes a viewer hasn't asked for yet
+        self.prefetched = OrderedDict()
+        self.counters = {"files": 0, "chunks": 0, "bytes": 0, "over_budget": 0, "hits": 0, "failed": 0}
+
+    def schedule(self, chat_id: int, message_id: int) -> None:
+        if not Telegram.WATCH_PREFETCH:
+            return
+        asyncio.create_task(self.warm(chat_id, message_id, tail=True))
+        if Telegram.PREFETCH_NEXT:
+            asyncio.create_task(self.warm(chat_id, message_id + 1, tail=False))
+
+    async def warm(self, chat_id: int, message_id: int, tail: bool) -> None:
+        key = (chat_id, message_id)
+        if (warmed_at := self.warmed.get(key)) and warmed_at > time() - WARM_TTL:
+            return
+        self.warmed[key] = time()
+        self.warmed.move_to_end(key)
+        while len(self.warmed) > MAX_TRACKED:
+            self.warmed.popitem(last=False)
+        async with self.semaphore:
+            try:
+                await self.warm_file(chat_id, message_id, tail)
+            except FIleNotFound:
+                pass
+            except Exception as e:
+                self.counters["failed"] += 1
+                logging.debug(f"Prefetch of message {message_id} in {chat_id} failed: {e!r}")
+
+    async def warm_file(self, chat_id: int, message_id: int, tail: bool) -> None:
+        index, _ = choose_client(chat_id, message_id)
+        streamer = get_byte_streamer(index)
+        file_meta = await streamer.get_file_properties(chat_id, message_id)
+        self.counters["files"] += 1
+        session = await streamer.generate_media_session(streamer.client, file_meta)
+        source = StreamSource(index, streamer, file_meta, session, await streamer.get_location(file_meta))
+        last_chunk = max(file_meta.file_size - 1, 0) // CHUNK_SIZE
+        for chunk_index in sorted({0, last_chunk} if tail else {0}):
+            if (file_meta.unique_id, chunk_index) in hot_cache.entries or \
+                    (file_meta.unique_id, chunk_index) in chunk_cache:
+                continue
+            if self.budget and self.budget.delay(CHUNK_SIZE) > 0:
+                self.counters["over_budget"] += 1
+                continue
+            if self.budget:
+                self.budget.consume(CHUNK_SIZE)
+            chunk = await streamer.get_chunk(source, file_meta.unique_id, chunk_index * CHUNK_SIZE, CHUNK_SIZE,
+                                             hot=True, priority=PRIORITY_BULK)
+            self.counters["chunks"] += 1
+            self.counters["bytes"] += len(chunk)
+            self.track(file_meta.unique_id, chunk_index)
+
+    def track(self, unique_id: str, chunk_index: int) -> None:
+        self.prefetched.setdefault(unique_id, set()).add(chunk_index)
+        self.prefetched.move_to_end(unique_id)
+        while len(self.prefetched) > MAX_TRACKED:
+            self.prefetched.popitem(last=False)
+
+    def record_request(self, unique_id: str, ranges: List[Tuple[int, int]]) -> None:
+        """
+        count prefetched chunks that a viewer then actually asked for
+        """
+        if not (chunks := self.prefetched.get(unique_id)):
+            return
+        for chunk_index in list(chunks):
+            if any(from_bytes // CHUNK_SIZE <= chunk_index <= until_bytes // CHUNK_SIZE
+                   for from_bytes, until_bytes in ranges):
+                chunks.discard(chunk_index)
+                self.counters["hits"] += 1
+
+    def stats(self) -> Dict[str, float]:
+        chunks = self.counters["chunks"]
+        return {**self.counters, "hit_rate": round(self.counters["hits"] / chunks, 3) if chunks else 0}
+
+
+prefetcher = Prefetcher(Telegram.PREFETCH_BUDGET)
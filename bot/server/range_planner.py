@@ -0,0 +1,71 @@
+from typing import List, Optional, Tuple
+
+# upload.GetFile rules: offset and limit are multiples of 4 KiB, 1 MiB is
+# divisible by limit and a request never crosses a 1 MiB boundary
+CHUNK_SIZE = 1024 * 1024
+MIN_BLOCK_SIZE = 4 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    message = 'Range not satisfiable'
+
+
+def parse_range_header(range_header: Optional[str], file_size: int) -> List[Tuple[int, int]]:
+    """
+    parse a `Range: bytes=...` header into inclusive (from, until) pairs,
+    clamped to the file size; an absent or empty header means the whole file
+    """
+    if not range_header:
+        return [(0, file_size - 1)]
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or not spec.strip():
+        raise RangeNotSatisfiable
+    ranges = []
+    for part in spec.split(","):
+        start, sep, end = part.strip().partition("-")
+        try:
+            if not sep:
+                raise ValueError
+            if start:
+                from_bytes = int(start)
+                until_bytes = int(end) if end else file_size - 1
+            else:
+                from_bytes = max(file_size - int(end), 0)
+                until_bytes = file_size - 1
+        except ValueError:
+            raise RangeNotSatisfiable
+        if from_bytes < 0 or until_bytes < from_bytes or from_bytes >= file_size:
+            continue
+        ranges.append((from_bytes, min(until_bytes, file_size - 1)))
+    if not ranges:
+        raise RangeNotSatisfiable
+    return ranges
+
+
+def coalesce_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    sort ranges and merge the ones that overlap or touch
+    """
+    merged = []
+    for from_bytes, until_bytes in sorted(ranges):
+        if merged and from_bytes <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], until_bytes))
+        else:
+            merged.append((from_bytes, until_bytes))
+    return merged
+
+
+def plan_range(from_bytes: int, until_bytes: int) -> List[Tuple[int, int]]:
+    """
+    legal (offset, limit) GetFile requests covering the inclusive byte range:
+    the smallest aligned block when it fits in one 1 MiB window, otherwise
+    whole 1 MiB chunks so bulk reads stay cacheable
+    """
+    first_chunk, last_chunk = from_bytes // CHUNK_SIZE, until_bytes // CHUNK_SIZE
+    if first_chunk != last_chunk:
+        return [(index * CHUNK_SIZE, CHUNK_SIZE) for index in range(first_chunk, last_chunk + 1)]
+    limit = MIN_BLOCK_SIZE
+    while from_bytes - from_bytes % limit + limit <= until_bytes:
+        limit *= 2
+    return [(from_bytes - from_bytes % limit, limit)]
+
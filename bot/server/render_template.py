@@ -1,4 +1,5 @@
 import re
+from html import escape
 from aiofiles import open as aiopen
 from os import path as ospath
 
@@ -6,10 +7,12 @@ from bot import LOGGER
 from bot.config import Telegram
 from bot.helper.database import Database
 from bot.helper.exceptions import InvalidHash
+from bot.helper.signing import sign_stream_query
 from bot.helper.index import get_messages
 from bot.helper.file_size import get_readable_file_size
-from bot.server.file_properties import get_file_ids
-from bot.telegram import StreamBot
+from bot.server.file_properties import choose_client, file_meta_cache
+from bot.server.prefetch import prefetcher
+from bot.telegram import StreamBot, multi_clients
 
 db = Database()
 
@@ -39,6 +42,9 @@ async def render_page(
     redirect_url="",
     msg="",
     chat_id="",
+    next_cursor=None,
+    prev_cursor=None,
+    query="",
 ):
     theme = await db.get_variable("theme")
     if theme is None or theme == "":
@@ -64,7 +70,10 @@ async def render_page(
                 html += admin_block
                 if Telegram.HIDE_CHANNEL:
                     html += hide_channel
-    elif route == "playlist":
+    elif route in ("playlist", "search"):
+        # the global search results reuse the playlist page, its search box
+        # then searches everything again
+        search_action = "/search" if route == "search" else f"/search/db/{id}"
         async with aiopen(ospath.join(tpath, "playlist.html"), "r") as f:
             html = (
                 (await f.read())
@@ -72,7 +81,10 @@ async def render_page(
                 .replace("<!-- Playlist -->", playlist)
                 .replace("<!-- Database -->", database)
                 .replace("<!-- Title -->", msg)
-                .replace("<!-- Parent_id -->", id)
+                .replace("<!-- SearchAction -->", search_action)
+                .replace("<!-- Query -->", escape(query))
+                .replace("<!-- NextCursor -->", next_cursor or "")
+                .replace("<!-- PrevCursor -->", prev_cursor or "")
             )
             if not is_admin:
                 html += admin_block
@@ -91,19 +103,24 @@ async def render_page(
                 .replace("<!-- Theme -->", theme.lower())
                 .replace("<!-- Title -->", msg)
                 .replace("<!-- Chat_id -->", chat_id)
+                .replace("<!-- NextCursor -->", next_cursor or "")
+                .replace("<!-- PrevCursor -->", prev_cursor or "")
             )
             if not is_admin:
                 html += admin_block
     else:
-        file_data = await get_file_ids(
-            StreamBot, chat_id=int(chat_id), message_id=int(id)
-        )
+        index, _ = choose_client(int(chat_id), int(id))
+        file_data = await file_meta_cache.get(multi_clients[index], int(chat_id), int(id))
         if file_data.unique_id[:6] != secure_hash:
             LOGGER.info(
                 "Link hash: %s - %s", secure_hash, file_data.unique_id[:6]
             )
             LOGGER.info("Invalid hash for message with - ID %s", id)
             raise InvalidHash
+        # start fetching while the viewer is still looking at the page
+        prefetcher.schedule(int(chat_id), int(id))
+        stream_query = sign_stream_query(int(chat_id), int(id), secure_hash, file_data.file_size,
+                                         file_data.mime_type)
         filename, tag, size = (
             file_data.file_name,
             file_data.mime_type.split("/")[0].strip(),
@@ -113,12 +130,10 @@ async def render_page(
             filename = "Proper Filename is Missing"
         filename = re.sub(r"[,|_\',]", " ", filename)
         if tag == "video":
-
-            message = await StreamBot.get_messages(chat_id, int(id))
-            caption = message.caption or message.video.file_name or ""
+            caption = file_data.caption or file_data.file_name or ""
 
             # Duration (in seconds → formatted hh:mm:ss)
-            duration_sec = getattr(message.video, "duration", None)
+            duration_sec = file_data.duration
             if duration_sec:
                 duration_sec = int(duration_sec)  # convert float to int
                 hours = duration_sec // 3600
@@ -143,6 +158,8 @@ async def render_page(
                     .replace("<!-- Size -->", size)
                     .replace("<!-- Tag -->", tag)
                     .replace("<!-- Username -->", StreamBot.me.username)
+                    .replace("<!-- Faststart -->", "&faststart=1" if Telegram.MP4_FASTSTART else "")
+                    .replace("<!-- StreamQuery -->", stream_query)
                 )
         else:
             async with aiopen(ospath.join(tpath, "dl.html")) as r:
@@ -151,5 +168,6 @@ async def render_page(
                     .replace("<!-- Filename -->", filename)
                     .replace("<!-- Theme -->", theme.lower())
                     .replace("<!-- Size -->", size)
+                    .replace("<!-- StreamQuery -->", stream_query)
                 )
     return html
@@ -0,0 +1,162 @@
+import asyncio
+from collections import OrderedDict
+from heapq import heappop, heappush
+from itertools import count
+from time import monotonic
+from typing import List, Optional, Tuple
+
+from bot.config import Telegram
+from bot.server.range_planner import CHUNK_SIZE
+
+# GetFile priority classes, lower is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_STREAM = 1
+PRIORITY_BULK = 2
+
+# blocks at the start of every request count as interactive, they decide
+# how long a player waits after opening or seeking
+INTERACTIVE_BLOCKS = 2
+INTERACTIVE_BYTES = INTERACTIVE_BLOCKS * CHUNK_SIZE
+
+
+def request_priority(ranges: List[Tuple[int, int]], file_size: int, download: bool) -> int:
+    """
+    small ranges are probes or scrubbing, the whole file asked for by a
+    download is bulk, anything else is playback; the range alone can't tell
+    them apart since players start with `bytes=0-` too
+    """
+    if sum(until_bytes - from_bytes + 1 for from_bytes, until_bytes in ranges) <= INTERACTIVE_BYTES:
+        return PRIORITY_INTERACTIVE
+    if download and len(ranges) == 1 and ranges[0] == (0, file_size - 1):
+        return PRIORITY_BULK
+    return PRIORITY_STREAM
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: int) -> float:
+        """
+        seconds until `amount` tokens are available, amounts above the
+        bucket size only wait for a full bucket
+        """
+        self.refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0
+
+    def consume(self, amount: int) -> None:
+        self.refill()
+        self.tokens -= amount
+
+    async def take(self, amount: int) -> None:
+        while (wait := self.delay(amount)) > 0:
+            await asyncio.sleep(wait)
+        self.consume(amount)
+
+
+def new_bucket(rate_kb: int) -> Optional[TokenBucket]:
+    if rate_kb <= 0:
+        return None
+    rate = rate_kb * 1024
+    # allow a couple of seconds (and at least two 1 MiB chunks) of burst
+    return TokenBucket(rate, max(2 * rate, 2 * 1024 * 1024))
+
+
+class UpstreamScheduler:
+    """
+    Admits upstream GetFile calls by priority class, then arrival order,
+    while keeping at most `max_active` running and the total rate under the
+    global token bucket.
+    """
+
+    def __init__(self, max_active: int, bucket: Optional[TokenBucket]):
+        self.max_active = max(1, max_active)
+        self.bucket = bucket
+        self.active = 0
+        self.queue = []
+        self.counter = count()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.admitted = [0, 0, 0]
+        self.queued = [0, 0, 0]
+
+    async def acquire(self, priority: int, size: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heappush(self.queue, (priority, next(self.counter), size, future))
+        self.dispatch()
+        if not future.done():
+            self.queued[priority] += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was granted just as the caller went away
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.active -= 1
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        while self.queue and self.active < self.max_active:
+            priority, _, size, future = self.queue[0]
+            if future.done():
+                heappop(self.queue)
+                continue
+            if self.bucket and (wait := self.bucket.delay(size)) > 0:
+                # strict priority: nothing overtakes the head of the queue
+                if self.timer is None:
+                    self.timer = asyncio.get_running_loop().call_later(wait, self.on_timer)
+                return
+            heappop(self.queue)
+            if self.bucket:
+                self.bucket.consume(size)
+            self.active += 1
+            self.admitted[priority] += 1
+            future.set_result(None)
+
+    def on_timer(self) -> None:
+        self.timer = None
+        self.dispatch()
+
+    def stats(self) -> dict:
+        return {"active": self.active, "waiting": sum(not item[3].done() for item in self.queue),
+                "admitted": self.admitted, "queued": self.queued}
+
+
+class ClientBuckets:
+    """
+    Per-IP token buckets, the least recently used ones are dropped once
+    `max_clients` addresses are tracked.
+    """
+
+    def __init__(self, rate_kb: int, max_clients: int = 4096):
+        self.rate_kb = rate_kb
+        self.max_clients = max_clients
+        self.buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def get(self, remote: Optional[str]) -> Optional[TokenBucket]:
+        if self.rate_kb <= 0:
+            return None
+        remote = remote or ""
+        if (bucket := self.buckets.get(remote)) is None:
+            bucket = self.buckets[remote] = new_bucket(self.rate_kb)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        self.buckets.move_to_end(remote)
+        return bucket
+
+
+upstream_scheduler = UpstreamScheduler(Telegram.UPSTREAM_CONCURRENCY, new_bucket(Telegram.GLOBAL_RATE_LIMIT))
+client_buckets = ClientBuckets(Telegram.CLIENT_RATE_LIMIT)
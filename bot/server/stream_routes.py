@@ -1,21 +1,37 @@
+import asyncio
 import json
 import logging
-import math
 import mimetypes
 import secrets
+from contextlib import aclosing
+from functools import partial
+from html import escape
+from typing import Optional
+from email.utils import formatdate, parsedate_to_datetime
 from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
 from bot.helper.chats import get_chats, post_playlist, posts_chat, posts_db_file
 from bot.helper.database import Database
 from bot.helper.search import search
+from bot.helper.search_index import search_index
 from bot.helper.thumbnail import get_image
 from bot.telegram import work_loads, multi_clients
+from bot.telegram.client_pool import client_pool
 from aiohttp_session import get_session
 from bot.config import Telegram
-from bot.helper.exceptions import FIleNotFound, InvalidHash
+from bot.helper.exceptions import FIleNotFound, InvalidHash, InvalidSignature
+from bot.helper.signing import verify_stream_query
 from bot.helper.index import get_files, posts_file
-from bot.server.custom_dl import ByteStreamer
+from bot.server.cdn import cdn_downloader
+from bot.server.chunk_cache import chunk_cache, hot_cache, read_cached_range
+from bot.server.custom_dl import chunk_flights, get_byte_streamer, stream_stats
+from bot.server.file_properties import FileMeta, choose_client, file_meta_cache
+from bot.server.media_session import session_pools
+from bot.server.mp4 import MP4_MIME_TYPES, Mp4Layout, mp4_index
+from bot.server.prefetch import prefetcher
+from bot.server.range_planner import CHUNK_SIZE, RangeNotSatisfiable, coalesce_ranges, parse_range_header
 from bot.server.render_template import render_page
+from bot.server.scheduler import PRIORITY_INTERACTIVE, client_buckets, request_priority, upstream_scheduler
 from bot.helper.cache import rm_cache
 
 from bot.telegram import StreamBot
@@ -86,7 +102,7 @@ async def delete_route(request):
     data = await request.json()
     id = data.get('delete_id')
     parent = data.get('parent')
-    if not (success := db.delete(id)):
+    if not (success := await db.delete(id)):
         return web.HTTPInternalServerError()
     if parent == 'root':
         return web.HTTPFound('/')
@@ -231,14 +247,13 @@ async def playlist_route(request):
     if username := session.get('user'):
         try:
             parent_id = request.query.get('db')
-            page = request.query.get('page', '1')
-            playlists = await db.get_Dbfolder(parent_id, page=page)
-            files = await db.get_dbFiles(parent_id, page=page)
+            cursor = request.query.get('cursor')
+            items, next_cursor, prev_cursor = await db.get_playlist(parent_id, cursor=cursor)
             text = await db.get_info(parent_id)
-            dhtml = await post_playlist(playlists)
-            dphtml = await posts_db_file(files)
+            dhtml = await post_playlist([item for item in items if item['type'] == 'folder'])
+            dphtml = await posts_db_file([item for item in items if item['type'] == 'file'])
             is_admin = username == Telegram.ADMIN_USERNAME
-            return web.Response(text=await render_page(parent_id, None, route='playlist', playlist=dhtml, database=dphtml, msg=text, is_admin=is_admin), content_type='text/html')
+            return web.Response(text=await render_page(parent_id, None, route='playlist', playlist=dhtml, database=dphtml, msg=text, is_admin=is_admin, next_cursor=next_cursor, prev_cursor=prev_cursor), content_type='text/html')
         except Exception as e:
             logging.critical(e.with_traceback(None))
             raise web.HTTPInternalServerError(text=str(e)) from e
@@ -252,15 +267,15 @@ async def dbsearch_route(request):
     session = await get_session(request)
     if username := session.get('user'):
         parent = request.match_info['parent']
-        page = request.query.get('page', '1')
+        cursor = request.query.get('cursor')
         query = request.query.get('q')
         is_admin = username == Telegram.ADMIN_USERNAME
         try:
-            files = await db.search_dbfiles(id=parent, page=page, query=query)
+            files, next_cursor, prev_cursor = await db.search_dbfiles(id=parent, cursor=cursor, query=query)
             dphtml = await posts_db_file(files)
             name = await db.get_info(parent)
             text = f"{name} - {query}"
-            return web.Response(text=await render_page(parent, None, route='playlist', database=dphtml, msg=text, is_admin=is_admin), content_type='text/html')
+            return web.Response(text=await render_page(parent, None, route='playlist', database=dphtml, msg=text, is_admin=is_admin, next_cursor=next_cursor, prev_cursor=prev_cursor, query=query), content_type='text/html')
         except Exception as e:
             logging.critical(e.with_traceback(None))
             raise web.HTTPInternalServerError(text=str(e)) from e
@@ -275,13 +290,13 @@ async def channel_route(request):
     if username := session.get('user'):
         chat_id = request.match_info['chat_id']
         chat_id = f"-100{chat_id}"
-        page = request.query.get('page', '1')
+        cursor = request.query.get('cursor')
         is_admin = username == Telegram.ADMIN_USERNAME
         try:
-            posts = await get_files(chat_id, page=page)
+            posts, next_cursor, prev_cursor = await get_files(chat_id, cursor=cursor)
             phtml = await posts_file(posts, chat_id)
             chat = await StreamBot.get_chat(int(chat_id))
-            return web.Response(text=await render_page(None, None, route='index', html=phtml, msg=chat.title, chat_id=chat_id.replace("-100", ""), is_admin=is_admin), content_type='text/html')
+            return web.Response(text=await render_page(None, None, route='index', html=phtml, msg=chat.title, chat_id=chat_id.replace("-100", ""), is_admin=is_admin, next_cursor=next_cursor, prev_cursor=prev_cursor), content_type='text/html')
         except Exception as e:
             logging.critical(e.with_traceback(None))
             raise web.HTTPInternalServerError(text=str(e)) from e
@@ -296,15 +311,61 @@ async def search_route(request):
     if username := session.get('user'):
         chat_id = request.match_info['chat_id']
         chat_id = f"-100{chat_id}"
-        page = request.query.get('page', '1')
+        cursor = request.query.get('cursor')
         query = request.query.get('q')
         is_admin = username == Telegram.ADMIN_USERNAME
         try:
-            posts = await search(chat_id, page=page, query=query)
+            posts, next_cursor, prev_cursor = await search(chat_id, cursor=cursor, query=query)
             phtml = await posts_file(posts, chat_id)
             chat = await StreamBot.get_chat(int(chat_id))
             text = f"{chat.title} - {query}"
-            return web.Response(text=await render_page(None, None, route='index', html=phtml, msg=text, chat_id=chat_id.replace("-100", ""), is_admin=is_admin), content_type='text/html')
+            return web.Response(text=await render_page(None, None, route='index', html=phtml, msg=text, chat_id=chat_id.replace("-100", ""), is_admin=is_admin, next_cursor=next_cursor, prev_cursor=prev_cursor), content_type='text/html')
+        except Exception as e:
+            logging.critical(e.with_traceback(None))
+            raise web.HTTPInternalServerError(text=str(e)) from e
+    else:
+        session['redirect_url'] = request.path_qs
+        return web.HTTPFound('/login')
+
+
+def search_result(document):
+    """
+    a global search hit the way the JSON API returns it
+    """
+    if document["source"] == "file":
+        chat_id, msg_id = document["chat_id"], document["msg_id"]
+        return {"type": "file", "title": document.get("title"), "chat_id": chat_id, "msg_id": msg_id,
+                "hash": document["hash"], "size": document.get("size"), "mime_type": document.get("type"),
+                "url": f"/watch/{str(chat_id).replace('-100', '')}?id={msg_id}&hash={document['hash']}",
+                "thumbnail": f"/api/thumb/{chat_id}?id={msg_id}"}
+    if document.get("type") == "folder":
+        return {"type": "folder", "id": str(document["_id"]), "title": document.get("name"),
+                "thumbnail": document.get("thumbnail"), "url": f"/playlist?db={document['_id']}"}
+    chat_id, msg_id = document["chat_id"], document["file_id"]
+    return {"type": "playlist_file", "id": str(document["_id"]), "title": document.get("name"),
+            "playlist": document.get("parent_folder"), "chat_id": chat_id, "msg_id": msg_id,
+            "hash": document["hash"], "size": document.get("size"), "mime_type": document.get("file_type"),
+            "url": f"/watch/{str(chat_id).replace('-100', '')}?id={msg_id}&hash={document['hash']}",
+            "thumbnail": document.get("thumbnail")}
+
+
+@routes.get('/search')
+async def global_search_route(request):
+    session = await get_session(request)
+    if username := session.get('user'):
+        query = request.query.get('q', '')
+        cursor = request.query.get('cursor')
+        try:
+            documents, next_cursor, prev_cursor = await db.search_all(query, cursor=cursor)
+            results = [search_result(document) for document in documents]
+            dhtml = await post_playlist([document for document, result in zip(documents, results) if result["type"] == "folder"])
+            files = [result for result in results if result["type"] != "folder"]
+            dphtml = await posts_db_file([{"_id": file.get("id", ""), "chat_id": file["chat_id"], "file_id": file["msg_id"],
+                                           "thumbnail": file["thumbnail"], "title": file["title"], "hash": file["hash"],
+                                           "size": file["size"], "file_type": file["mime_type"],
+                                           "parent_folder": file.get("playlist", "")} for file in files])
+            # results span channels and playlists, the playlist edit buttons don't apply
+            return web.Response(text=await render_page(None, None, route='search', playlist=dhtml, database=dphtml, msg=f"Search - {escape(query)}", next_cursor=next_cursor, prev_cursor=prev_cursor, query=query), content_type='text/html')
         except Exception as e:
             logging.critical(e.with_traceback(None))
             raise web.HTTPInternalServerError(text=str(e)) from e
@@ -313,6 +374,21 @@ async def search_route(request):
         return web.HTTPFound('/login')
 
 
+@routes.get('/api/search')
+async def global_search_api(request):
+    session = await get_session(request)
+    if not session.get('user'):
+        return web.json_response({'msg': 'Login required'}, status=401)
+    query = request.query.get('q', '')
+    try:
+        limit = min(max(int(request.query.get('limit', '50')), 1), 100)
+    except ValueError:
+        raise web.HTTPBadRequest(text="limit must be a number")
+    documents, next_cursor, prev_cursor = await db.search_all(query, cursor=request.query.get('cursor'), per_page=limit)
+    return web.json_response({'query': query, 'results': [search_result(document) for document in documents],
+                              'next': next_cursor, 'prev': prev_cursor, 'complete': search_index.ready})
+
+
 @routes.get('/api/thumb/{chat_id}', allow_head=True)
 async def get_thumbnail(request):
     chat_id = request.match_info['chat_id']
@@ -325,6 +401,29 @@ async def get_thumbnail(request):
     return response
 
 
+@routes.get('/api/stats')
+async def stats_route(request):
+    # client names, loads and cache contents are for the admin only
+    session = await get_session(request)
+    if session.get('user') != Telegram.ADMIN_USERNAME:
+        return web.json_response({'msg': 'Admin login required'}, status=403)
+    return web.json_response({
+        'hot_cache': hot_cache.stats(),
+        'chunk_cache': chunk_cache.stats(),
+        'chunk_flights': chunk_flights.stats(),
+        'file_meta_cache': file_meta_cache.stats(),
+        'stream': stream_stats,
+        'media_sessions': {client.name: pool.stats() for client, pool in session_pools.items()},
+        'work_loads': work_loads,
+        'clients': client_pool.stats(),
+        'scheduler': upstream_scheduler.stats(),
+        'cdn': cdn_downloader.stats(),
+        'mp4_index': mp4_index.stats(),
+        'prefetch': prefetcher.stats(),
+        'search_index': search_index.stats(),
+    })
+
+
 @routes.get('/watch/{chat_id}', allow_head=True)
 async def stream_handler_watch(request: web.Request):
     session = await get_session(request)
@@ -338,7 +437,7 @@ async def stream_handler_watch(request: web.Request):
         except InvalidHash as e:
             raise web.HTTPForbidden(text=e.message) from e
         except FIleNotFound as e:
-            db.delete_file(chat_id=chat_id, msg_id=message_id, hash=secure_hash)
+            await db.delete_file(chat_id=chat_id, msg_id=message_id, hash=secure_hash)
             raise web.HTTPNotFound(text=e.message) from e
         except (AttributeError, BadStatusLine, ConnectionResetError):
             pass
@@ -359,10 +458,10 @@ async def stream_handler(request: web.Request):
         #name = request.match_info['encoded_name']
         secure_hash = request.query.get('hash')
         return await media_streamer(request, int(chat_id), int(message_id), secure_hash)
-    except InvalidHash as e:
+    except (InvalidHash, InvalidSignature) as e:
         raise web.HTTPForbidden(text=e.message) from e
     except FIleNotFound as e:
-        db.delete_file(chat_id=chat_id, msg_id=message_id, hash=secure_hash)
+        await db.delete_file(chat_id=chat_id, msg_id=message_id, hash=secure_hash)
         raise web.HTTPNotFound(text=e.message) from e
     except (AttributeError, BadStatusLine, ConnectionResetError):
         pass
@@ -371,89 +470,290 @@ async def stream_handler(request: web.Request):
         raise web.HTTPInternalServerError(text=str(e))
 
 
-class_cache = {}
+# ranges up to this size are served from the chunk caches when possible
+PROBE_SIZE = 64 * 1024
 
 
-async def media_streamer(request: web.Request, chat_id: int, id: int, secure_hash: str):
-    range_header = request.headers.get("Range", 0)
+async def get_stripes(index: int, chat_id: int, id: int, file_id: FileMeta, size: int):
+    unique_id = file_id.unique_id
+    candidates = [i for i in client_pool.rank(file_id.dc_id, size, exclude=[index]) if client_pool.is_available(i)]
+    candidates = candidates[:Telegram.STRIPE_CLIENTS - 1]
 
-    index = min(work_loads, key=work_loads.get)
-    faster_client = multi_clients[index]
+    async def resolve(i):
+        streamer = get_byte_streamer(i)
+        try:
+            stripe_file_id = await streamer.get_file_properties(chat_id=chat_id, message_id=id)
+        except Exception as e:
+            logging.debug(f"Client {i} can't access message {id}: {e}")
+            return None
+        if stripe_file_id.unique_id != unique_id:
+            return None
+        return streamer, stripe_file_id, i
 
-    if Telegram.MULTI_CLIENT:
-        logging.info(f"Client {index} is now serving {request.remote}")
+    return [stripe for stripe in await asyncio.gather(*[resolve(i) for i in candidates]) if stripe]
 
-    if faster_client in class_cache:
-        tg_connect = class_cache[faster_client]
-        logging.debug(f"Using cached ByteStreamer object for client {index}")
-    else:
-        logging.debug(f"Creating new ByteStreamer object for client {index}")
-        tg_connect = ByteStreamer(faster_client)
-        class_cache[faster_client] = tg_connect
-    logging.debug("before calling get_file_properties")
+
+def etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def is_not_modified(request: web.Request, etag: str, last_modified: int) -> bool:
+    if (if_none_match := request.headers.get("If-None-Match")) is not None:
+        return etag_matches(if_none_match, etag)
+    if last_modified and (if_modified_since := request.headers.get("If-Modified-Since")):
+        try:
+            return parsedate_to_datetime(if_modified_since).timestamp() >= last_modified
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def if_range_matches(if_range: str, etag: str, last_modified: int) -> bool:
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag
+    try:
+        return last_modified and parsedate_to_datetime(if_range).timestamp() == last_modified
+    except (TypeError, ValueError):
+        return False
+
+
+async def yield_multipart(read_range, ranges, parts, boundary: str):
+    for (from_bytes, until_bytes), part_header in zip(ranges, parts):
+        yield part_header
+        async with aclosing(read_range(from_bytes, until_bytes)) as body:
+            async for chunk in body:
+                yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+async def read_upstream(chat_id: int, id: int, file_id: FileMeta, from_bytes: int, until_bytes: int) -> bytes:
+    """
+    a small range read in one piece by the least busy client, for indexing
+    """
+    index, _ = choose_client(chat_id, id, until_bytes - from_bytes + 1)
+    tg_connect = get_byte_streamer(index)
     file_id = await tg_connect.get_file_properties(chat_id=chat_id, message_id=id)
-    logging.debug("after calling get_file_properties")
+    async with aclosing(tg_connect.yield_file(file_id, index, from_bytes, until_bytes,
+                                              priority=PRIORITY_INTERACTIVE)) as body:
+        return b"".join([bytes(chunk) async for chunk in body])
+
+
+async def get_faststart_layout(chat_id: int, id: int, file_id: FileMeta) -> Optional[Mp4Layout]:
+    if get_mime_type(file_id) not in MP4_MIME_TYPES:
+        return None
+    try:
+        layout = await mp4_index.get(file_id.unique_id, file_id.file_size,
+                                     partial(read_upstream, chat_id, id, file_id))
+    except Exception as e:
+        logging.debug(f"Can't build fast-start layout for message {id}: {e!r}")
+        return None
+    return layout if layout and layout.is_virtual else None
+
+
+def get_cached_faststart_layout(file_id: FileMeta) -> Optional[Mp4Layout]:
+    """
+    the fast-start layout if it was built before, never reads the file
+    """
+    layout = mp4_index.entries.get(file_id.unique_id)
+    return layout if layout and layout.is_virtual else None
+
+
+def is_probe(range_header: str) -> bool:
+    """
+    a single small closed range, what players and link checkers send first
+    """
+    unit, _, spec = (range_header or "").partition("=")
+    start, _, end = spec.strip().partition("-")
+    return unit.strip() == "bytes" and start.isdigit() and end.isdigit() and 0 <= int(end) - int(start) < PROBE_SIZE
+
+
+def is_download(request: web.Request) -> bool:
+    """
+    players always send a Range header, even from the start of the file,
+    and browsers mark media element requests; a plain GET or a page
+    navigation is a download
+    """
+    if request.query.get("faststart") or request.headers.get("Sec-Fetch-Dest") in ("video", "audio"):
+        return False
+    return "Range" not in request.headers or request.headers.get("Sec-Fetch-Dest") == "document"
+
+
+def get_mime_type(file_id: FileMeta) -> str:
+    if file_id.mime_type:
+        return file_id.mime_type
+    return file_id.file_name and mimetypes.guess_type(file_id.file_name)[0] or "application/octet-stream"
+
+
+def content_disposition(file_id: FileMeta) -> str:
+    file_name = file_id.file_name
+    if not file_name:
+        try:
+            file_name = f"{secrets.token_hex(2)}.{file_id.mime_type.split('/')[1]}"
+        except (IndexError, AttributeError):
+            file_name = f"{secrets.token_hex(2)}.unknown"
+    return f'attachment; filename="{file_name}"'
+
+
+async def send_head(request: web.Request, status: int, headers: dict) -> web.StreamResponse:
+    response = web.StreamResponse(status=status, headers=headers)
+    await response.prepare(request)
+    return response
+
+
+async def write_body(request: web.Request, response: web.StreamResponse, body) -> web.StreamResponse:
+    """
+    send the body chunk by chunk, every write waits for the socket to drain
+    so a slow reader holds back the download instead of filling memory
+    """
+    async with aclosing(body):
+        await response.prepare(request)
+        try:
+            async for chunk in body:
+                await response.write(chunk)
+        except ConnectionError:
+            # the viewer went away, aclosing stops the download
+            return response
+    await response.write_eof()
+    return response
+
+
+async def media_streamer(request: web.Request, chat_id: int, id: int, secure_hash: str):
+    range_header = request.headers.get("Range")
+
+    # signed links are checked before anything touches Telegram
+    if "sig" in request.query or Telegram.REQUIRE_SIGNED_LINKS:
+        if not verify_stream_query(chat_id, id, request.query):
+            stream_stats["rejected_links"] += 1
+            raise InvalidSignature
+
+    index, known = choose_client(chat_id, id)
+    probe = request.method == "HEAD" or is_probe(range_header)
+    if probe and known:
+        # size, type and validators don't change with the file reference, a
+        # HEAD or probe is answered without touching a client at all
+        index, tg_connect, file_id = None, None, known
+    else:
+
+        if Telegram.MULTI_CLIENT:
+            logging.info(f"Client {index} is now serving {request.remote}")
+
+        tg_connect = get_byte_streamer(index)
+        logging.debug("before calling get_file_properties")
+        file_id = await tg_connect.get_file_properties(chat_id=chat_id, message_id=id)
+        logging.debug("after calling get_file_properties")
 
     if file_id.unique_id[:6] != secure_hash:
         logging.debug(f"Invalid hash for message with ID {id}")
         raise InvalidHash
 
-    file_size = file_id.file_size
+    # the player asks for a copy with moov moved to the front, it has the
+    # same size but different bytes and so its own ETag; HEAD and 304 only
+    # go by a layout built before, reading the file is left to a body
+    faststart = Telegram.MP4_FASTSTART and request.query.get("faststart")
+    layout = get_cached_faststart_layout(file_id) if faststart else None
 
-    if range_header:
-        from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-        from_bytes = int(from_bytes)
-        until_bytes = int(until_bytes) if until_bytes else file_size - 1
-    else:
-        from_bytes = request.http_range.start or 0
-        until_bytes = (request.http_range.stop or file_size) - 1
+    file_size = file_id.file_size
+    etag = f'"{file_id.unique_id}-faststart"' if layout else f'"{file_id.unique_id}"'
+    last_modified = file_id.date
+    headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+    if Telegram.STREAM_CACHE_CONTROL:
+        headers["Cache-Control"] = Telegram.STREAM_CACHE_CONTROL
+    if last_modified:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+
+    if is_not_modified(request, etag, last_modified):
+        return web.Response(status=304, headers=headers)
+
+    if faststart and request.method != "HEAD" and file_id.unique_id not in mp4_index.entries:
+        if layout := await get_faststart_layout(chat_id, id, file_id):
+            etag = headers["ETag"] = f'"{file_id.unique_id}-faststart"'
+
+    if range_header and (if_range := request.headers.get("If-Range")):
+        if not if_range_matches(if_range, etag, last_modified):
+            # the client's partial copy is stale, send the whole file again
+            range_header = None
 
-    if (until_bytes > file_size) or (from_bytes < 0) or (until_bytes < from_bytes):
+    try:
+        ranges = coalesce_ranges(parse_range_header(range_header, file_size))
+    except RangeNotSatisfiable:
         return web.Response(
             status=416,
             body="416: Range not satisfiable",
-            headers={"Content-Range": f"bytes */{file_size}"},
+            headers={**headers, "Content-Range": f"bytes */{file_size}"},
         )
 
-    chunk_size = 1024 * 1024
-    until_bytes = min(until_bytes, file_size - 1)
-
-    offset = from_bytes - (from_bytes % chunk_size)
-    first_part_cut = from_bytes - offset
-    last_part_cut = until_bytes % chunk_size + 1
-
-    req_length = until_bytes - from_bytes + 1
-    part_count = math.ceil(until_bytes / chunk_size) - \
-        math.floor(offset / chunk_size)
-    body = tg_connect.yield_file(
-        file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size
-    )
+    req_length = sum(until_bytes - from_bytes + 1 for from_bytes, until_bytes in ranges)
+    headers["Content-Disposition"] = content_disposition(file_id)
+    mime_type = headers["Content-Type"] = get_mime_type(file_id)
+
+    if request.method == "HEAD":
+        stream_stats["head_requests"] += 1
+        if len(ranges) > 1:
+            # the multipart length depends on a random boundary, leave it out
+            return await send_head(request, 206, {**headers, "Content-Type": "multipart/byteranges"})
+        from_bytes, until_bytes = ranges[0]
+        headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{file_size}"
+        return await send_head(request, 206 if range_header else 200,
+                               {**headers, "Content-Length": str(req_length)})
+
+    prefetcher.record_request(file_id.unique_id, ranges)
+
+    if len(ranges) == 1 and req_length <= PROBE_SIZE and not layout:
+        from_bytes, until_bytes = ranges[0]
+        if (data := await read_cached_range(file_id.unique_id, from_bytes, until_bytes)) is not None:
+            stream_stats["cached_probes"] += 1
+            headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{file_size}"
+            return web.Response(status=206 if range_header else 200, body=data, headers=headers)
+
+    if tg_connect is None:
+        # a probe for bytes that aren't cached after all
+        stream_stats["uncached_probes"] += 1
+        index, _ = choose_client(chat_id, id, req_length)
+        tg_connect = get_byte_streamer(index)
+        file_id = await tg_connect.get_file_properties(chat_id=chat_id, message_id=id)
+
+    stripes = []
+    if Telegram.STRIPE_CLIENTS > 1 and len(multi_clients) > 1 and req_length > CHUNK_SIZE:
+        stripes = await get_stripes(index, chat_id, id, file_id, req_length)
+    priority = request_priority(ranges, file_size, is_download(request))
+    bucket = client_buckets.get(request.remote)
+    read_range = partial(tg_connect.yield_file, file_id, index, stripes=stripes, priority=priority, bucket=bucket)
+    if layout:
+        read_range = partial(layout.read, read_range)
+
+    if len(ranges) > 1:
+        boundary = secrets.token_hex(16)
+        parts = [
+            f"--{boundary}\r\nContent-Type: {mime_type}\r\n"
+            f"Content-Range: bytes {from_bytes}-{until_bytes}/{file_size}\r\n\r\n".encode()
+            for from_bytes, until_bytes in ranges
+        ]
+        body_length = req_length + sum(len(part) + 2 for part in parts) + len(f"--{boundary}--\r\n")
+        response = web.StreamResponse(
+            status=206,
+            headers={
+                **headers,
+                "Content-Type": f"multipart/byteranges; boundary={boundary}",
+                "Content-Length": str(body_length),
+            },
+        )
+        return await write_body(
+            request, response,
+            yield_multipart(read_range, ranges, parts, boundary))
 
-    mime_type = file_id.mime_type
-    file_name = file_id.file_name
-    disposition = "attachment"
-
-    if mime_type:
-        if not file_name:
-            try:
-                file_name = f"{secrets.token_hex(2)}.{mime_type.split('/')[1]}"
-            except (IndexError, AttributeError):
-                file_name = f"{secrets.token_hex(2)}.unknown"
-    else:
-        if file_name:
-            mime_type = mimetypes.guess_type(file_id.file_name)
-        else:
-            mime_type = "application/octet-stream"
-            file_name = f"{secrets.token_hex(2)}.unknown"
+    from_bytes, until_bytes = ranges[0]
+    body = read_range(from_bytes, until_bytes)
 
-    return web.Response(
+    response = web.StreamResponse(
         status=206 if range_header else 200,
-        body=body,
         headers={
-            "Content-Type": f"{mime_type}",
+            **headers,
             "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
             "Content-Length": str(req_length),
-            "Content-Disposition": f'{disposition}; filename="{file_name}"',
-            "Accept-Ranges": "bytes",
         },
     )
+    return await write_body(request, response, body)
@@ -0,0 +1,91 @@
+from time import monotonic
+from typing import Dict, Iterable, List, Optional
+
+from bot.telegram import multi_clients
+
+EWMA_ALPHA = 0.2
+DEFAULT_LATENCY = 0.3
+DEFAULT_THROUGHPUT = 4 * 1024 * 1024
+
+
+class ClientStats:
+    __slots__ = ("in_flight_bytes", "latency", "throughput", "cooldown_until", "flood_waits", "fetched_bytes")
+
+    def __init__(self):
+        self.in_flight_bytes = 0
+        self.latency: Dict[int, float] = {}
+        self.throughput: Dict[int, float] = {}
+        self.cooldown_until = 0.0
+        self.flood_waits = 0
+        self.fetched_bytes = 0
+
+
+class ClientPool:
+    """
+    Picks the bot client expected to finish a request first, from the
+    bytes it still has to download and the GetFile latency and throughput
+    it has shown for the file's DC. Clients hit by a FloodWait are left
+    out until it expires.
+    """
+
+    def __init__(self):
+        self.clients: Dict[int, ClientStats] = {}
+
+    def get(self, index: int) -> ClientStats:
+        if index not in self.clients:
+            self.clients[index] = ClientStats()
+        return self.clients[index]
+
+    def is_available(self, index: int) -> bool:
+        return self.get(index).cooldown_until <= monotonic()
+
+    def expected_time(self, index: int, dc_id: Optional[int], size: int) -> float:
+        stats = self.get(index)
+        if dc_id is None:
+            latency = min(stats.latency.values(), default=DEFAULT_LATENCY)
+            throughput = max(stats.throughput.values(), default=DEFAULT_THROUGHPUT)
+        else:
+            latency = stats.latency.get(dc_id, DEFAULT_LATENCY)
+            throughput = stats.throughput.get(dc_id, DEFAULT_THROUGHPUT)
+        return latency + (stats.in_flight_bytes + size) / throughput
+
+    def rank(self, dc_id: Optional[int] = None, size: int = 0, exclude: Iterable[int] = ()) -> List[int]:
+        candidates = [index for index in multi_clients if index not in exclude]
+        available = [index for index in candidates if self.is_available(index)]
+        if not available:
+            # everyone is rate limited, the one that recovers first goes first
+            return sorted(candidates, key=lambda index: self.get(index).cooldown_until)
+        return sorted(available, key=lambda index: self.expected_time(index, dc_id, size))
+
+    def acquire(self, index: int, size: int) -> None:
+        self.get(index).in_flight_bytes += size
+
+    def release(self, index: int, size: int) -> None:
+        stats = self.get(index)
+        stats.in_flight_bytes = max(stats.in_flight_bytes - size, 0)
+
+    def record(self, index: int, dc_id: int, size: int, elapsed: float) -> None:
+        stats = self.get(index)
+        stats.fetched_bytes += size
+        elapsed = max(elapsed, 1e-3)
+        for values, sample in ((stats.latency, elapsed), (stats.throughput, size / elapsed)):
+            values[dc_id] = sample if dc_id not in values else \
+                (1 - EWMA_ALPHA) * values[dc_id] + EWMA_ALPHA * sample
+
+    def flood_wait(self, index: int, seconds: float) -> None:
+        stats = self.get(index)
+        stats.flood_waits += 1
+        stats.cooldown_until = max(stats.cooldown_until, monotonic() + seconds)
+
+    def stats(self) -> dict:
+        now = monotonic()
+        return {index: {"in_flight_bytes": stats.in_flight_bytes,
+                        "latency": {dc_id: round(value, 3) for dc_id, value in stats.latency.items()},
+                        "throughput": {dc_id: int(value) for dc_id, value in stats.throughput.items()},
+                        "cooldown": round(max(stats.cooldown_until - now, 0), 1),
+                        "flood_waits": stats.flood_waits,
+                        "fetched_bytes": stats.fetched_bytes}
+                for index, stats in self.clients.items()}
+
+
+client_pool = ClientPool()
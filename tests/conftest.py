@@ -0,0 +1,7 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# set before bot.config reads config.env, so tests never reach a real database
+os.environ["DATABASE_URL"] = "mongodb://localhost:1"
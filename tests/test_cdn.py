@@ -0,0 +1,128 @@
+import asyncio
+import random
+from hashlib import sha256
+
+import pytest
+from pyrogram import raw
+from pyrogram.crypto import aes
+
+from bot.config import Telegram
+from bot.server import custom_dl
+from bot.server.cdn import HASH_PIECE_SIZE, CdnDownloader
+from bot.server.custom_dl import ByteStreamer, StreamSource
+from bot.server.range_planner import CHUNK_SIZE
+
+rng = random.Random(16)
+DATA = rng.randbytes(3 * CHUNK_SIZE + 5000)
+KEY = rng.randbytes(32)
+# the last 4 bytes of the IV are the block counter of the offset
+IV = rng.randbytes(12) + bytes(4)
+ENCRYPTED = aes.ctr256_encrypt(DATA, KEY, bytearray(IV))
+
+
+def file_hashes(offset, count=8):
+    return [raw.types.FileHash(offset=start, limit=HASH_PIECE_SIZE,
+                               hash=sha256(DATA[start:start + HASH_PIECE_SIZE]).digest())
+            for start in range(offset, min(offset + count * HASH_PIECE_SIZE, len(DATA)), HASH_PIECE_SIZE)]
+
+
+class FakeClient:
+    name = "test-cdn"
+
+
+class FakeMeta:
+    media_id = 1
+    dc_id = 2
+
+
+class MainSession:
+    """
+    The file's own DC: redirects CDN capable GetFile calls and serves
+    reuploads, hashes and plain downloads.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    async def send(self, query, **kwargs):
+        self.calls.append(type(query).__name__)
+        if isinstance(query, raw.functions.upload.GetFile):
+            if query.cdn_supported:
+                return raw.types.upload.FileCdnRedirect(dc_id=203, file_token=b"token", encryption_key=KEY,
+                                                        encryption_iv=IV, file_hashes=file_hashes(0, 2))
+            return raw.types.upload.File(type=raw.types.storage.FilePartial(), mtime=0,
+                                         bytes=DATA[query.offset:query.offset + query.limit])
+        if isinstance(query, raw.functions.upload.ReuploadCdnFile):
+            return []
+        if isinstance(query, raw.functions.upload.GetCdnFileHashes):
+            return file_hashes(query.offset)
+
+
+class CdnSession:
+    """
+    The CDN DC: asks for one reupload, then serves encrypted bytes.
+    """
+
+    def __init__(self):
+        self.reupload = True
+        self.calls = 0
+
+    async def send(self, query, **kwargs):
+        self.calls += 1
+        if self.reupload:
+            self.reupload = False
+            return raw.types.upload.CdnFileReuploadNeeded(request_token=b"request")
+        return raw.types.upload.CdnFile(bytes=ENCRYPTED[query.offset:query.offset + query.limit])
+
+
+@pytest.fixture
+def downloader(monkeypatch):
+    downloader = CdnDownloader()
+    cdn_session = CdnSession()
+
+    async def get_session(client, dc_id):
+        return cdn_session
+
+    downloader.get_session = get_session
+    downloader.cdn_session = cdn_session
+    monkeypatch.setattr(custom_dl, "cdn_downloader", downloader)
+    monkeypatch.setattr(Telegram, "CDN_DOWNLOADS", True)
+    return downloader
+
+
+def make_source():
+    streamer = ByteStreamer(FakeClient())
+    return streamer, StreamSource(0, streamer, FakeMeta(), MainSession(), None)
+
+
+def test_redirected_file_is_downloaded_from_the_cdn(downloader):
+    streamer, source = make_source()
+
+    async def main():
+        chunks = [await streamer.fetch_chunk(source, offset, CHUNK_SIZE) for offset in range(0, len(DATA), CHUNK_SIZE)]
+        small = await streamer.fetch_chunk(source, 3 * CHUNK_SIZE + 4096, 4096)
+        return b"".join(chunks), small
+
+    data, small = asyncio.run(main())
+    assert data == DATA
+    assert small == DATA[3 * CHUNK_SIZE + 4096:3 * CHUNK_SIZE + 8192]
+    assert source.session.calls.count("GetFile") == 1
+    assert "ReuploadCdnFile" in source.session.calls and "GetCdnFileHashes" in source.session.calls
+    stats = downloader.stats()
+    assert stats["redirects"] == 1 and stats["reuploads"] == 1 and stats["fallbacks"] == 0
+
+
+def test_hash_mismatch_falls_back_to_the_own_dc(downloader):
+    streamer, source = make_source()
+
+    async def main():
+        await streamer.fetch_chunk(source, 0, CHUNK_SIZE)
+        downloader.files[(FakeClient.name, FakeMeta.media_id)].hashes[CHUNK_SIZE] = b"tampered"
+        return await streamer.fetch_chunk(source, CHUNK_SIZE, CHUNK_SIZE)
+
+    assert asyncio.run(main()) == DATA[CHUNK_SIZE:2 * CHUNK_SIZE]
+    assert downloader.stats()["fallbacks"] == 1
+    # later chunks skip the CDN
+    cdn_calls = downloader.cdn_session.calls
+    assert asyncio.run(streamer.fetch_chunk(source, 2 * CHUNK_SIZE, CHUNK_SIZE)) == DATA[2 * CHUNK_SIZE:3 * CHUNK_SIZE]
+    assert downloader.cdn_session.calls == cdn_calls
@@ -0,0 +1,179 @@
+import asyncio
+import random
+from itertools import count
+from time import perf_counter
+
+from pyrogram import raw
+from pyrogram.errors import FileReferenceExpired, InternalServerError
+from pyrogram.file_id import FileType
+
+from bot.config import Telegram
+from bot.server import custom_dl, file_properties
+from bot.server.custom_dl import ByteStreamer, stream_stats
+from bot.server.file_properties import FileMeta, file_meta_cache
+from bot.server.range_planner import CHUNK_SIZE
+from bot.telegram import work_loads
+
+unique_ids = count()
+
+
+class FakeClient:
+    name = "test-bot"
+
+
+class FakeSession:
+    """
+    Serves GetFile from `data`, counting the calls per offset.
+    """
+
+    def __init__(self, data: bytes, delay: float = 0.02):
+        self.data = data
+        self.delay = delay
+        self.calls = {}
+
+    async def send(self, query):
+        self.calls[query.offset] = self.calls.get(query.offset, 0) + 1
+        await asyncio.sleep(self.delay)
+        return raw.types.upload.File(type=raw.types.storage.FilePartial(), mtime=0,
+                                     bytes=self.data[query.offset:query.offset + query.limit])
+
+
+class ExpiringSession(FakeSession):
+    """
+    Rejects locations carrying an old file reference, expires the current
+    one once `expire_at` is read and answers `failures` 500s at `fail_at`.
+    """
+
+    def __init__(self, data: bytes, expire_at: int = -1, fail_at: int = -1, failures: int = 0):
+        super().__init__(data, delay=0.005)
+        self.file_reference = b"old"
+        self.expire_at = expire_at
+        self.fail_at = fail_at
+        self.failures = failures
+
+    async def send(self, query):
+        if query.location.file_reference != self.file_reference:
+            raise FileReferenceExpired()
+        if query.offset == self.fail_at and self.failures:
+            self.failures -= 1
+            raise InternalServerError()
+        chunk = await super().send(query)
+        if query.offset == self.expire_at:
+            self.file_reference = b"new"
+        return chunk
+
+
+def make_meta(size: int, file_reference: bytes = b"ref", unique_id: str = "") -> FileMeta:
+    # a fresh unique id per test keeps the shared chunk caches out of the way
+    return FileMeta(-100, 5, 2, FileType.VIDEO, 1, 2, file_reference, "", size, "video/mp4", "test.mp4",
+                    unique_id or f"test-{next(unique_ids)}", 0)
+
+
+def make_streamer(session) -> ByteStreamer:
+    streamer = ByteStreamer(FakeClient())
+
+    async def generate_media_session(client, file_id):
+        return session
+
+    streamer.generate_media_session = generate_media_session
+    work_loads.setdefault(0, 0)
+    return streamer
+
+
+async def read_all(streamer, file_meta, from_bytes, until_bytes) -> bytes:
+    return b"".join([bytes(chunk) async for chunk in streamer.yield_file(file_meta, 0, from_bytes, until_bytes)])
+
+
+def random_bytes(size: int) -> bytes:
+    return random.Random(size).randbytes(size)
+
+
+def test_concurrent_readers_share_one_fetch_per_chunk():
+    data = random_bytes(8 * CHUNK_SIZE)
+    session = FakeSession(data)
+    streamer = make_streamer(session)
+    file_meta = make_meta(len(data))
+
+    async def main():
+        return await asyncio.gather(*[read_all(streamer, file_meta, 0, len(data) - 1) for _ in range(10)])
+
+    assert all(result == data for result in asyncio.run(main()))
+    assert session.calls == {offset: 1 for offset in range(0, len(data), CHUNK_SIZE)}
+    assert work_loads[0] == 0
+
+
+def test_cancelled_reader_leaves_shared_fetches_running():
+    data = random_bytes(8 * CHUNK_SIZE)
+    session = FakeSession(data, delay=0.05)
+    streamer = make_streamer(session)
+    file_meta = make_meta(len(data))
+
+    async def main():
+        first = asyncio.create_task(read_all(streamer, file_meta, 0, len(data) - 1))
+        second = asyncio.create_task(read_all(streamer, file_meta, 0, len(data) - 1))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == data
+    assert all(calls == 1 for calls in session.calls.values())
+    assert not custom_dl.chunk_flights.calls
+    assert work_loads[0] == 0
+
+
+def test_expired_file_reference_is_refreshed_mid_stream(monkeypatch):
+    data = random_bytes(6 * CHUNK_SIZE)
+    session = ExpiringSession(data, expire_at=2 * CHUNK_SIZE)
+    streamer = make_streamer(session)
+    unique_id = f"test-{next(unique_ids)}"
+    lookups = []
+
+    async def get_file_ids(client, chat_id, message_id):
+        lookups.append(message_id)
+        return make_meta(len(data), session.file_reference, unique_id)
+
+    monkeypatch.setattr(file_properties, "get_file_ids", get_file_ids)
+    refreshes = stream_stats["reference_refreshes"]
+
+    async def main():
+        file_meta = await file_meta_cache.get(streamer.client, -100, 5)
+        return await read_all(streamer, file_meta, 0, len(data) - 1)
+
+    assert asyncio.run(main()) == data
+    # one lookup for the stream and a single shared one after the expiry
+    assert len(lookups) == 2
+    assert stream_stats["reference_refreshes"] > refreshes
+    assert work_loads[0] == 0
+
+
+def test_internal_server_errors_are_retried():
+    data = random_bytes(4 * CHUNK_SIZE)
+    session = ExpiringSession(data, fail_at=3 * CHUNK_SIZE, failures=2)
+    streamer = make_streamer(session)
+    retries = stream_stats["retries"]
+
+    assert asyncio.run(read_all(streamer, make_meta(len(data), b"old"), 0, len(data) - 1)) == data
+    assert stream_stats["retries"] == retries + 2
+    assert session.failures == 0
+
+
+def test_pipelined_reads_beat_sequential_ones(monkeypatch):
+    """
+    throughput of a 16 MiB range against a DC answering each GetFile after
+    50 ms, one request at a time (the old loop) against the default window
+    """
+    data = random_bytes(16 * CHUNK_SIZE)
+    session = FakeSession(data, delay=0.05)
+    streamer = make_streamer(session)
+    throughput = {}
+
+    async def measure():
+        started = perf_counter()
+        assert await read_all(streamer, make_meta(len(data)), 0, len(data) - 1) == data
+        return len(data) / (perf_counter() - started) / 1e6
+
+    for prefetch_chunks in (1, 4):
+        monkeypatch.setattr(Telegram, "PREFETCH_CHUNKS", prefetch_chunks)
+        throughput[prefetch_chunks] = asyncio.run(measure())
+    print(f"PREFETCH_CHUNKS=1: {throughput[1]:.1f} MB/s, PREFETCH_CHUNKS=4: {throughput[4]:.1f} MB/s")
+    assert throughput[4] > 2.5 * throughput[1]
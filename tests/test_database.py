@@ -0,0 +1,148 @@
+import asyncio
+from time import monotonic
+
+import pytest
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
+
+from bot.helper import database
+from bot.helper.cursor import NEXT, PREV, encode_cursor
+
+
+async def stub_stream(chunks, interval=0.01):
+    for _ in range(chunks):
+        await asyncio.sleep(interval)
+        yield b"\0" * 1024
+
+
+def test_slow_query_doesnt_stall_streams(monkeypatch):
+    """
+    a query against a server that never answers runs until its timeout,
+    a stream on the same loop keeps its pace meanwhile
+    """
+
+    async def main():
+        # nothing listens on port 1, server selection waits out the timeout
+        monkeypatch.setattr(database, "mongo_client", AsyncIOMotorClient(
+            "mongodb://localhost:1", serverSelectionTimeoutMS=500, timeoutMS=500))
+        db = database.Database()
+        query = asyncio.ensure_future(db.list_tgfiles("-100"))
+        gaps, last = [], monotonic()
+        async for _ in stub_stream(30):
+            gaps.append(monotonic() - last)
+            last = monotonic()
+        # the stream finished before the query timed out
+        assert not query.done()
+        with pytest.raises(PyMongoError):
+            await query
+        return gaps
+
+    gaps = asyncio.run(main())
+    assert max(gaps) < 0.1
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, keys):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    async def to_list(self, length):
+        return self.documents[:length]
+
+
+class FakeCollection:
+    def __init__(self, documents):
+        self.documents = documents
+        self.queries = []
+
+    def find(self, query):
+        self.queries.append(query)
+        return FakeCursor(self.documents)
+
+
+RANKED = sorted((float(score), ObjectId().binary) for score in range(120))
+TAMPERED = [encode_cursor(NEXT, [1.0, "abc"]), encode_cursor(PREV, ["abc", 1.0]), encode_cursor(NEXT, [True, b"x"]),
+            encode_cursor(NEXT, [{"$gt": 0}, b"x"]), encode_cursor(NEXT, [1.0]), encode_cursor(NEXT, [1.0, b"x", 2])]
+
+
+@pytest.mark.parametrize("cursor", TAMPERED)
+def test_tampered_search_cursor_is_the_first_page(cursor):
+    assert database.ranked_slice(RANKED, cursor, 50) == database.ranked_slice(RANKED, None, 50)
+
+
+def test_search_cursors_round_trip():
+    ids, next_cursor, _ = database.ranked_slice(RANKED, None, 50)
+    following, _, prev_cursor = database.ranked_slice(RANKED, next_cursor, 50)
+    assert not set(ids) & set(following)
+    assert database.ranked_slice(RANKED, prev_cursor, 50)[0] == ids
+    # an empty query scores every title 0
+    zeros = sorted((0, ObjectId().binary) for _ in range(60))
+    _, next_cursor, _ = database.ranked_slice(zeros, None, 50)
+    assert len(database.ranked_slice(zeros, next_cursor, 50)[0]) == 10
+
+
+@pytest.mark.parametrize("position", [["5"], [{"$ne": None}], [True], [5, 6]])
+def test_tampered_keyset_cursor_is_the_first_page(position):
+    collection = FakeCollection([{"msg_id": 9}, {"msg_id": 8}])
+    documents, _, prev_cursor = asyncio.run(
+        database.keyset_page(collection, {"chat_id": "-100"}, ["msg_id"], encode_cursor(NEXT, position), 50))
+    assert collection.queries == [{"chat_id": "-100"}]
+    assert prev_cursor is None
+
+
+def test_keyset_cursor_reaches_the_filter():
+    collection = FakeCollection([])
+    keys = ["type", "file_id", "_id"]
+    position = ["folder", None, ObjectId()]
+    asyncio.run(database.keyset_page(collection, {}, keys, encode_cursor(NEXT, position), 50))
+    assert collection.queries == [{"$and": [{}, database.keyset_filter(keys, position, "$lt")]}]
+
+
+class FakeFiles:
+    """
+    a files collection without the unique index, it stores every insert
+    """
+
+    def __init__(self, documents=()):
+        self.documents = list(documents)
+
+    def matches(self, document, query):
+        return all(document.get(key) in value["$in"] if isinstance(value, dict) else document.get(key) == value
+                   for key, value in query.items())
+
+    async def find_one(self, query, projection=None):
+        return next((document for document in self.documents if self.matches(document, query)), None)
+
+    async def find(self, query, projection=None):
+        for document in list(self.documents):
+            if self.matches(document, query):
+                yield document
+
+    async def insert_one(self, document):
+        document["_id"] = ObjectId()
+        self.documents.append(document)
+
+    async def insert_many(self, documents, ordered=True):
+        for document in documents:
+            await self.insert_one(document)
+
+
+def test_inserts_dedupe_without_the_unique_index(monkeypatch):
+    monkeypatch.setattr(database, "built_indexes", set())
+    db = database.Database()
+    db.files = FakeFiles([{"_id": ObjectId(), "chat_id": "-100", "msg_id": 1}])
+
+    async def main():
+        await db.add_tgfiles("-100", "1", "AgADaa", "a", "1 MB", "video/mp4")
+        await db.add_tgfiles("-100", "2", "AgADaa", "b", "1 MB", "video/mp4")
+        await db.add_btgfiles([{"chat_id": "-100", "msg_id": msg_id, "hash": "AgADaa", "title": "c"}
+                               for msg_id in (1, 2, 3, 3)])
+
+    asyncio.run(main())
+    assert sorted(document["msg_id"] for document in db.files.documents) == [1, 2, 3]
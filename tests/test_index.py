@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from bot.config import Telegram
+from bot.helper import index
+from bot.helper.cursor import NEXT, PREV, encode_cursor
+from bot.helper.index import get_files, history_position
+
+
+@pytest.mark.parametrize("cursor", [None, "", "garbage", "a/b", "../../x", encode_cursor(NEXT, ["x"]),
+                                    encode_cursor(PREV, [-3]), encode_cursor(PREV, [])])
+def test_mangled_cursors_are_the_first_page(cursor):
+    assert history_position(cursor) == (NEXT, 0)
+
+
+def test_cursor_positions():
+    assert history_position(encode_cursor(NEXT, [42])) == (NEXT, 42)
+    assert history_position(encode_cursor(PREV, [42])) == (PREV, 42)
+
+
+def test_pages_are_cached_by_position(monkeypatch, tmp_path):
+    (tmp_path / "cache").mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Telegram, "SESSION_STRING", "session")
+    fetched = []
+
+    async def get_history(chat_id, cursor=None):
+        fetched.append(cursor)
+        return [], None, None
+
+    monkeypatch.setattr(index, "get_history", get_history)
+
+    async def main():
+        for cursor in (None, "garbage", "a/b", encode_cursor(NEXT, [42]), encode_cursor(NEXT, ["42"])):
+            await get_files("-100", cursor)
+
+    asyncio.run(main())
+    assert fetched == [None, encode_cursor(NEXT, [42])]
+    assert sorted(path.name for path in (tmp_path / "cache").iterdir()) == ["-100-head.json", "-100-next-42.json"]
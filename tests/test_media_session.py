@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from bot.server import media_session
+from bot.server.media_session import MediaSessionPool
+
+
+class FakeStorage:
+    async def dc_id(self):
+        return 2
+
+    async def auth_key(self):
+        return b"key"
+
+    async def test_mode(self):
+        return False
+
+
+class FakeClient:
+    name = "test-media"
+    storage = FakeStorage()
+
+
+class FakeSession:
+    # DCs whose sessions never finish starting, like Session.start retrying
+    # an unreachable address
+    unreachable = set()
+    created = []
+
+    def __init__(self, client, dc_id, auth_key, test_mode, is_media=False):
+        self.dc_id = dc_id
+        self.stopped = False
+        self.created.append(self)
+
+    async def start(self):
+        if self.dc_id in self.unreachable:
+            await asyncio.Event().wait()
+
+    async def stop(self):
+        self.stopped = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    FakeSession.created = []
+    FakeSession.unreachable = {2}
+    monkeypatch.setattr(media_session, "Session", FakeSession)
+    monkeypatch.setattr(media_session, "CONNECT_TIMEOUT", 0.05)
+    return MediaSessionPool(FakeClient(), 2)
+
+
+def test_unreachable_dc_times_out_and_releases_the_lock(pool):
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.get(2)
+        # the lock is free again, a later viewer gets a session once the
+        # DC is back
+        FakeSession.unreachable.clear()
+        return await asyncio.wait_for(pool.get(2), 1)
+
+    session = asyncio.run(main())
+    assert FakeSession.created[0].stopped
+    assert not session.stopped
+
+
+def test_stop_stops_pooled_sessions(pool):
+    FakeSession.unreachable.clear()
+
+    async def main():
+        await pool.get(2)
+        await pool.fill(2)
+        await pool.stop()
+
+    asyncio.run(main())
+    assert len(FakeSession.created) == 2
+    assert all(session.stopped for session in FakeSession.created)
+    assert not pool.sessions
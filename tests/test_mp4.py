@@ -0,0 +1,183 @@
+import asyncio
+import random
+import struct
+
+import pytest
+
+from bot.server.mp4 import Mp4Layout, build_layout, read_box_header, shift_chunk_offsets
+
+
+def box(kind, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def large_box_header(kind, size):
+    return struct.pack(">I4sQ", 1, kind, size)
+
+
+def offset_table(kind, offsets):
+    code = ">I" if kind == b"stco" else ">Q"
+    return box(kind, bytes(4) + struct.pack(">I", len(offsets)) + b"".join(struct.pack(code, o) for o in offsets))
+
+
+def moov_box(*tables):
+    traks = b"".join(box(b"trak", box(b"mdia", box(b"minf", box(b"stbl", table)))) for table in tables)
+    return box(b"moov", box(b"mvhd", bytes(100)) + traks)
+
+
+def read_offsets(data):
+    """
+    chunk offsets of every stco/co64 table in the file, in order
+    """
+    offsets = []
+
+    def walk(start, end):
+        offset = start
+        while offset + 8 <= end:
+            kind, header, size = read_box_header(data, offset, end)
+            if kind in (b"moov", b"trak", b"mdia", b"minf", b"stbl"):
+                walk(offset + header, offset + size)
+            elif kind in (b"stco", b"co64"):
+                count = struct.unpack_from(">I", data, offset + header + 4)[0]
+                code = ">I" if kind == b"stco" else ">Q"
+                step = struct.calcsize(code)
+                offsets.extend(struct.unpack_from(code, data, offset + header + 8 + i * step)[0] for i in range(count))
+            offset += size
+
+    walk(0, len(data))
+    return offsets
+
+
+def make_mp4(rng, trailing=b""):
+    """
+    ftyp, free, mdat holding samples, then moov with an stco and a co64
+    track pointing at them, then `trailing` boxes; (file, sample offsets)
+    """
+    ftyp = box(b"ftyp", b"isom" + bytes(4) + b"isomiso2mp41")
+    free = box(b"free", bytes(rng.randint(0, 50)))
+    samples = [rng.randbytes(rng.randint(1, 3000)) for _ in range(40)]
+    mdat_start = len(ftyp) + len(free)
+    offsets, position = [], mdat_start + 8
+    for sample in samples:
+        offsets.append(position)
+        position += len(sample)
+    mdat = box(b"mdat", b"".join(samples))
+    moov = moov_box(offset_table(b"stco", offsets[::2]), offset_table(b"co64", offsets[1::2]))
+    return ftyp + free + mdat + moov + trailing, offsets[::2] + offsets[1::2]
+
+
+def box_offsets(data):
+    offsets, offset = [], 0
+    while offset < len(data):
+        offsets.append(offset)
+        offset += read_box_header(data, offset, len(data))[2]
+    return offsets
+
+
+def reader(data):
+    async def read(from_bytes, until_bytes):
+        return data[from_bytes:until_bytes + 1]
+    return read
+
+
+def virtual_bytes(layout, data, from_bytes, until_bytes):
+    async def read_range(start, end):
+        yield data[start:end + 1]
+
+    async def main():
+        return b"".join([bytes(chunk) async for chunk in layout.read(read_range, from_bytes, until_bytes)])
+
+    return asyncio.run(main())
+
+
+def test_faststart_copy_keeps_size_and_samples():
+    rng = random.Random(17)
+    for _ in range(20):
+        data, offsets = make_mp4(rng, trailing=box(b"udta", rng.randbytes(rng.randint(0, 500))))
+        layout = asyncio.run(build_layout(len(data), reader(data), 1 << 20))
+        assert layout.is_virtual
+        virtual = virtual_bytes(layout, data, 0, len(data) - 1)
+        assert len(virtual) == len(data)
+        # moov follows ftyp, free and mdat move up by its size
+        kinds = [read_box_header(virtual, offset, len(virtual))[0] for offset in box_offsets(virtual)]
+        assert kinds == [b"ftyp", b"moov", b"free", b"mdat", b"udta"]
+        shifted = read_offsets(virtual)
+        assert shifted == [offset + layout.size for offset in offsets]
+        for old, new in zip(offsets, shifted):
+            assert virtual[new:new + 16] == data[old:old + 16]
+        # the data after moov keeps its place
+        udta = box_offsets(data)[-1]
+        assert virtual[udta:] == data[udta:]
+
+
+def test_random_ranges_match_the_rearranged_file():
+    rng = random.Random(170)
+    data, _ = make_mp4(rng, trailing=box(b"free", bytes(64)))
+    layout = asyncio.run(build_layout(len(data), reader(data), 1 << 20))
+    virtual = virtual_bytes(layout, data, 0, len(data) - 1)
+    for _ in range(500):
+        from_bytes = rng.randrange(len(data))
+        until_bytes = rng.randint(from_bytes, min(len(data) - 1, from_bytes + rng.choice([0, 10, 1000, len(data)])))
+        assert virtual_bytes(layout, data, from_bytes, until_bytes) == virtual[from_bytes:until_bytes + 1]
+        pieces = layout.map_range(from_bytes, until_bytes)
+        assert sum(len(piece) if isinstance(piece, memoryview) else piece[1] - piece[0] + 1
+                   for piece in pieces) == until_bytes - from_bytes + 1
+
+
+def test_layouts_that_stay_as_they_are():
+    rng = random.Random(1700)
+    data, _ = make_mp4(rng)
+    ftyp_size = read_box_header(data, 0, len(data))[2]
+    moov_at = data.index(b"moov") - 4
+    faststart = data[:ftyp_size] + data[moov_at:] + data[ftyp_size:moov_at]
+    assert not asyncio.run(build_layout(len(faststart), reader(faststart), 1 << 20)).is_virtual
+    # moov over the size limit is streamed as it is
+    assert not asyncio.run(build_layout(len(data), reader(data), 100)).is_virtual
+    # not an MP4 at all, boxes that aren't ftyp first or no boxes at all
+    other = box(b"EBML", rng.randbytes(1000))
+    assert asyncio.run(build_layout(len(other), reader(other), 1 << 20)) is None
+    mkv = bytes.fromhex("1a45dfa3") + rng.randbytes(1000)
+    with pytest.raises(ValueError):
+        asyncio.run(build_layout(len(mkv), reader(mkv), 1 << 20))
+
+
+class SparseFile:
+    """
+    a file too big to hold, zeros apart from the pieces given
+    """
+
+    def __init__(self, size, pieces):
+        self.size = size
+        self.pieces = pieces
+
+    async def read(self, from_bytes, until_bytes):
+        data = bytearray(until_bytes - from_bytes + 1)
+        for start, piece in self.pieces.items():
+            first, last = max(from_bytes, start), min(until_bytes, start + len(piece) - 1)
+            if first <= last:
+                data[first - from_bytes:last - from_bytes + 1] = piece[first - start:last - start + 1]
+        return bytes(data)
+
+
+@pytest.mark.parametrize("kind, virtual", [(b"stco", False), (b"co64", True)])
+def test_offsets_past_4gb(kind, virtual):
+    ftyp = box(b"ftyp", b"isom" + bytes(4))
+    mdat_size = 0xFFFFFFF0
+    last_sample = 0xFFFFFF80
+    moov = moov_box(offset_table(kind, [len(ftyp) + 16, last_sample]))
+    size = len(ftyp) + mdat_size + len(moov)
+    sparse = SparseFile(size, {0: ftyp + large_box_header(b"mdat", mdat_size), len(ftyp) + mdat_size: moov})
+    layout = asyncio.run(build_layout(size, sparse.read, 1 << 20))
+    # moving the last sample up by moov's size overflows a 32 bit table,
+    # such a file is streamed as it is
+    assert layout.is_virtual == virtual
+    if virtual:
+        assert read_offsets(layout.moov) == [len(ftyp) + 16 + len(moov), last_sample + len(moov)]
+
+
+def test_shift_chunk_offsets_only_moves_offsets_in_range():
+    moov = bytearray(moov_box(offset_table(b"stco", [10, 500, 2000]), offset_table(b"co64", [20, 3000])))
+    shift_chunk_offsets(moov, range(100, 2500), 64, 8)
+    assert read_offsets(bytes(moov)) == [10, 564, 2064, 20, 3000]
+    with pytest.raises(OverflowError):
+        shift_chunk_offsets(moov, range(0, 4000), 0xFFFFFFFF, 8)
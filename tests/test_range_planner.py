@@ -0,0 +1,62 @@
+import random
+
+import pytest
+
+from bot.server.range_planner import (CHUNK_SIZE, MIN_BLOCK_SIZE, RangeNotSatisfiable, coalesce_ranges,
+                                      parse_range_header, plan_range)
+
+
+def is_legal(offset, limit):
+    return (offset % MIN_BLOCK_SIZE == 0 and limit % MIN_BLOCK_SIZE == 0 and CHUNK_SIZE % limit == 0
+            and offset // CHUNK_SIZE == (offset + limit - 1) // CHUNK_SIZE)
+
+
+def random_range(rng):
+    file_size = rng.choice([rng.randint(1, 10 * CHUNK_SIZE), rng.randint(1, 5000),
+                            rng.randint(CHUNK_SIZE - 10, CHUNK_SIZE + 10)])
+    from_bytes = rng.randint(0, file_size - 1)
+    span = rng.choice([1, 10, 5000, CHUNK_SIZE, 3 * CHUNK_SIZE])
+    return file_size, from_bytes, rng.randint(from_bytes, min(file_size - 1, from_bytes + span))
+
+
+def test_plan_range_properties():
+    rng = random.Random(6)
+    for _ in range(20000):
+        _, from_bytes, until_bytes = random_range(rng)
+        blocks = plan_range(from_bytes, until_bytes)
+        assert all(is_legal(offset, limit) for offset, limit in blocks), (from_bytes, until_bytes, blocks)
+        assert blocks[0][0] <= from_bytes and blocks[-1][0] + blocks[-1][1] > until_bytes
+        for (offset, limit), (next_offset, _) in zip(blocks, blocks[1:]):
+            assert offset + limit == next_offset
+        assert len(blocks) == until_bytes // CHUNK_SIZE - from_bytes // CHUNK_SIZE + 1
+        if len(blocks) > 1:
+            assert all(limit == CHUNK_SIZE for _, limit in blocks)
+
+
+def test_plan_range_small_reads():
+    assert plan_range(0, 1) == [(0, MIN_BLOCK_SIZE)]
+    assert plan_range(CHUNK_SIZE - 10, CHUNK_SIZE + 5) == [(0, CHUNK_SIZE), (CHUNK_SIZE, CHUNK_SIZE)]
+
+
+def test_coalesce_ranges_properties():
+    rng = random.Random(7)
+    for _ in range(5000):
+        file_size = rng.randint(1, 100)
+        ranges = [tuple(sorted((rng.randrange(file_size), rng.randrange(file_size)))) for _ in range(rng.randint(1, 6))]
+        merged = coalesce_ranges(ranges)
+        covered = {byte for from_bytes, until_bytes in ranges for byte in range(from_bytes, until_bytes + 1)}
+        assert {byte for from_bytes, until_bytes in merged for byte in range(from_bytes, until_bytes + 1)} == covered
+        for (_, until_bytes), (next_from, _) in zip(merged, merged[1:]):
+            assert next_from > until_bytes + 1
+
+
+def test_parse_range_header():
+    assert parse_range_header("bytes=0-1, -5, 10-", 100) == [(0, 1), (95, 99), (10, 99)]
+    assert parse_range_header(None, 100) == [(0, 99)]
+    assert parse_range_header("bytes=50-1000", 100) == [(50, 99)]
+
+
+@pytest.mark.parametrize("header", ["bytes=200-", "bytes=abc", "items=0-1", "bytes=5-2"])
+def test_parse_range_header_unsatisfiable(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header(header, 100)
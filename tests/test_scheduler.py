@@ -0,0 +1,22 @@
+from bot.server.range_planner import CHUNK_SIZE
+from bot.server.scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_STREAM, request_priority
+
+FILE_SIZE = 100 * CHUNK_SIZE
+
+
+def test_small_ranges_are_interactive():
+    assert request_priority([(0, 1023)], FILE_SIZE, download=False) == PRIORITY_INTERACTIVE
+    assert request_priority([(0, 1023)], FILE_SIZE, download=True) == PRIORITY_INTERACTIVE
+
+
+def test_playback_from_the_start_is_not_bulk():
+    # a <video> element starts with Range: bytes=0-
+    assert request_priority([(0, FILE_SIZE - 1)], FILE_SIZE, download=False) == PRIORITY_STREAM
+
+
+def test_whole_file_download_is_bulk():
+    assert request_priority([(0, FILE_SIZE - 1)], FILE_SIZE, download=True) == PRIORITY_BULK
+
+
+def test_partial_download_streams():
+    assert request_priority([(CHUNK_SIZE, FILE_SIZE - 1)], FILE_SIZE, download=True) == PRIORITY_STREAM
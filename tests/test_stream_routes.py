@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+from aiohttp_session import SESSION_KEY, Session
+from pyrogram.file_id import FileType
+
+from bot.config import Telegram
+from bot.server import stream_routes
+from bot.server.file_properties import FileMeta
+from bot.server.mp4 import mp4_index
+
+UNIQUE_ID = "AgADfaststart"
+META = FileMeta(-100, 5, 2, FileType.VIDEO, 1, 2, b"ref", "", 10 << 20, "video/mp4", "test.mp4", UNIQUE_ID, 1)
+
+
+class FakeStreamer:
+    async def get_file_properties(self, chat_id, message_id):
+        return META
+
+
+def make_streamer(monkeypatch):
+    reads = []
+
+    async def read_upstream(*args):
+        reads.append(args)
+        raise ConnectionError
+
+    monkeypatch.setattr(Telegram, "MP4_FASTSTART", True)
+    monkeypatch.setattr(stream_routes, "choose_client", lambda *args: (0, META))
+    monkeypatch.setattr(stream_routes, "get_byte_streamer", lambda index: FakeStreamer())
+    monkeypatch.setattr(stream_routes, "read_upstream", read_upstream)
+    mp4_index.entries.pop(UNIQUE_ID, None)
+
+    def stream(method, headers=None):
+        request = make_mocked_request(method, "/-100/5?faststart=1", headers=headers)
+        return asyncio.run(stream_routes.media_streamer(request, -100, 5, UNIQUE_ID[:6]))
+
+    return stream, reads
+
+
+def test_head_doesnt_build_the_faststart_layout(monkeypatch):
+    stream, reads = make_streamer(monkeypatch)
+    response = stream("HEAD", {"Range": "bytes=0-1"})
+    assert response.status == 206
+    assert response.headers["ETag"] == f'"{UNIQUE_ID}"'
+    assert not reads
+
+
+def test_not_modified_doesnt_build_the_faststart_layout(monkeypatch):
+    stream, reads = make_streamer(monkeypatch)
+    response = stream("GET", {"If-None-Match": f'"{UNIQUE_ID}"'})
+    assert response.status == 304
+    assert not reads
+
+
+# aiohttp_session keys requests with a plain string
+@pytest.mark.filterwarnings("ignore::aiohttp.web_exceptions.NotAppKeyWarning")
+def test_stats_are_for_the_admin_only(monkeypatch):
+    monkeypatch.setattr(Telegram, "ADMIN_USERNAME", "admin")
+
+    def stats(user):
+        request = make_mocked_request("GET", "/api/stats")
+        request[SESSION_KEY] = Session(None, data={"session": {"user": user}} if user else None, new=not user)
+        return asyncio.run(stream_routes.stats_route(request))
+
+    for user in (None, "viewer"):
+        response = stats(user)
+        assert response.status == 403
+        assert "work_loads" not in json.loads(response.body)
+    assert "work_loads" in json.loads(stats("admin").body)
@@ -0,0 +1,37 @@
+import asyncio
+
+from pyrogram.file_id import FileType
+
+from bot.helper import thumbnail
+from bot.server import file_properties
+from bot.server.file_properties import FileMeta, file_meta_cache
+
+
+class FakeClient:
+    def __init__(self, name):
+        self.name = name
+        self.downloads = []
+
+    async def download_media(self, media):
+        self.downloads.append(media)
+        return f"downloads/{media}.jpg"
+
+
+def test_thumbnail_reuses_the_chosen_clients_record(monkeypatch):
+    clients = {0: FakeClient("thumb-bot-0"), 1: FakeClient("thumb-bot-1")}
+    lookups = []
+
+    async def get_file_ids(client, chat_id, message_id):
+        lookups.append(client.name)
+
+    meta = FileMeta(-100, 7, 2, FileType.VIDEO, 1, 2, b"ref", "", 1, "video/mp4", "a.mp4", "AgADthumb", 0,
+                    thumbs=["thumb"])
+    # the watch page looked the message up through client 1
+    file_meta_cache.put(("thumb-bot-1", -100, 7), meta)
+    monkeypatch.setattr(thumbnail, "multi_clients", clients)
+    monkeypatch.setattr(thumbnail, "choose_client", lambda chat_id, message_id: (1, meta))
+    monkeypatch.setattr(file_properties, "get_file_ids", get_file_ids)
+
+    assert asyncio.run(thumbnail.get_image(-100, 7)) == "downloads/thumb.jpg"
+    assert clients[1].downloads == ["thumb"] and not clients[0].downloads
+    assert not lookups